@@ -1,11 +1,21 @@
 import glob
+import io
 import os
+import re
+import shutil
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from urllib.parse import quote
 
 import pandas as pd
 import requests
 from tqdm import tqdm
 
+COPY_BUFFER_SIZE = 1 << 20
+BATCH_LINES = 10000
+# A whole SCANS line of an MGF file and its line break (LF or CRLF, optional on the last line)
+SCANS_LINE = re.compile(rb"^(SCANS[^\r\n]*)(\r?\n|$)", re.MULTILINE)
+
 
 def download_task_zip(task_id, output_dir="./downloaded_content"):
     """
@@ -42,30 +52,81 @@ def download_task_zip(task_id, output_dir="./downloaded_content"):
         print(f"Error: {response.status_code}")
 
 
+def scan_task_archive(tar_file, handlers):
+    """
+    Read a task tar file in a single streaming pass and hand each member of interest to a handler as it appears.
+    The archive is read sequentially (tarfile stream mode), so its index is never loaded and nothing is extracted
+    unless a handler writes it.
+    :param tar_file: Path to the tar file.
+    :param handlers: dict mapping a subfolder of the archive to a callable(relative name, file object) called for each
+    regular file under that subfolder. The file object is only readable during the call.
+    :return: dict mapping each subfolder to the number of members handled.
+    """
+    counts = {subfolder: 0 for subfolder in handlers}
+    with tarfile.open(tar_file, "r|*") as tar_ref:
+        for member in tar_ref:
+            if not member.isfile():
+                continue
+            name = member.name[2:] if member.name.startswith("./") else member.name
+            for subfolder, handler in handlers.items():
+                if name.startswith(subfolder):
+                    handler(name, tar_ref.extractfile(member))
+                    counts[subfolder] += 1
+                    break
+    return counts
+
+
+def extract_member_to(extract_path):
+    """
+    Build a scan_task_archive handler that copies members to extract_path, keeping their path inside the archive.
+    :param extract_path: Folder to extract to.
+    :return: handler callable.
+    """
+    root = os.path.abspath(extract_path)
+
+    def handler(name, fileobj):
+        target = os.path.abspath(os.path.join(root, name))
+        if not target.startswith(root + os.sep):
+            print(f"Skipping member outside of the extraction folder: {name}")
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as out_f:
+            shutil.copyfileobj(fileobj, out_f, COPY_BUFFER_SIZE)
+
+    return handler
+
+
+def read_tsv_members(frames):
+    """
+    Build a scan_task_archive handler that reads .tsv members straight from the archive into DataFrames.
+    :param frames: list the DataFrames are appended to.
+    :return: handler callable.
+    """
+    def handler(name, fileobj):
+        if name.endswith(".tsv"):
+            # Stream-mode members are not seekable, which pandas requires; the summaries are small enough to buffer
+            frames.append(pd.read_csv(io.BytesIO(fileobj.read()), sep="\t"))
+
+    return handler
+
+
 def extract_results(tar_file, subfolder):
     """
     Extract the contents of a specific subfolder from a tar file.
     :param tar_file: Path to the tar file.
     :param subfolder: Subfolder to extract from the tar file.
     """
-    import tarfile
-    import os
-
     print(f"Extracting results from {tar_file}...")
-    with tarfile.open(tar_file, "r") as tar_ref:
-        # Filter members belonging to the specified subfolder
-        members = [m for m in tar_ref.getmembers() if m.name.startswith(subfolder)]
-        if not members:
-            print(f"No contents found for subfolder: {subfolder}")
-            return
+    extract_path = os.path.splitext(tar_file)[0]
+    counts = scan_task_archive(tar_file, {subfolder: extract_member_to(extract_path)})
+    if not counts[subfolder]:
+        print(f"No contents found for subfolder: {subfolder}")
+        return
 
-        # Extract only the filtered members
-        extract_path = os.path.splitext(tar_file)[0]
-        tar_ref.extractall(path=extract_path, members=members)
-        print(
-            f"Extracted contents of subfolder '{subfolder}' successfully to '{extract_path}'."
-        )
-        return extract_path
+    print(
+        f"Extracted contents of subfolder '{subfolder}' successfully to '{extract_path}'."
+    )
+    return extract_path
 
 
 def download_tsv_summary(task, output_dir="./downloaded_content"):
@@ -90,41 +151,104 @@ def download_tsv_summary(task, output_dir="./downloaded_content"):
         return None
 
 
-def insert_mgf_info(task: str, name: str, tsv_file_path: str, base_folder: str = "./downloaded_content"):
+def _annotation_strings(name: str, subset: pd.DataFrame) -> dict:
+    """
+    Build the MASSQL_* lines inserted before the SCANS line of each spectrum of one MGF file.
+    :param name: name of the MassQL query (MASSQL_ORIGIN).
+    :param subset: rows of the TSV summary of the file.
+    :return: dict mapping each new_scan to its annotation string. The first row of each scan wins.
+    """
+    subset = subset.drop_duplicates("new_scan", keep="first")
+    return {
+        int(row.new_scan): (
+            f"MASSQL_ORIGIN={name}\n"
+            f"MASSQL_PEPMASS={row.precmz}\n"
+            f"MASSQL_ORIGINAL_PATH={row.original_path}\n"
+            f"MASSQL_SCAN={row.scan}\n"
+            f"MASSQL_NEW_SCAN={row.new_scan}\n"
+            f"MASSQL_NEW_FILENAME={row.new_filename}\n"
+            f"MASSQL_I={row.i}\n"
+        )
+        for row in subset.itertuples(index=False)
+    }
+
+
+def annotate_mgf_file(mgf_file_path: str, output_mgf_file_path: str, annotations: dict, batch_lines=BATCH_LINES):
+    """
+    Write a copy of an MGF file with the annotation of each spectrum inserted before its SCANS line.
+    Lines are written in batches through a large buffer.
+    :param mgf_file_path: MGF file to annotate.
+    :param output_mgf_file_path: Output MGF file.
+    :param annotations: dict mapping each scan number to its annotation string.
+    :param batch_lines: number of lines collected before each write.
+    :return: tuple of (output file path, number of annotated spectra, list of the scans without annotation).
+    """
+    annotated = 0
+    missing = []
+    batch = []
+    with open(mgf_file_path, "r") as f, open(output_mgf_file_path, "w", buffering=COPY_BUFFER_SIZE) as out_f:
+        for line in f:
+            if line.startswith("SCANS"):
+                scan_number = line.split("=")[1].strip()
+                insert_string = annotations.get(int(scan_number))
+                if insert_string is None:
+                    missing.append(scan_number)
+                else:
+                    batch.append(insert_string)
+                    annotated += 1
+            batch.append(line)
+            if len(batch) >= batch_lines:
+                out_f.writelines(batch)
+                batch.clear()
+        out_f.writelines(batch)
+    return output_mgf_file_path, annotated, missing
+
+
+def load_annotations(task: str, name: str, tsv_file_path: str, base_folder: str = "./downloaded_content") -> list:
+    """
+    Read the TSV summary of a task and build the annotations of each of its MGF files.
+    :param task: task ID for the GNPS2 job, used to construct the MGF file paths.
+    :param name: name of the MassQL query, written as MASSQL_ORIGIN.
+    :param tsv_file_path: TSV file generated during the MASSQL job.
+    :param base_folder: Folder under which the MGF files of the task were extracted.
+    :return: list of (file stem, MGF file path, dict mapping each scan number to its annotation string), in order of
+    first appearance in the summary.
+    """
+    df = pd.read_csv(tsv_file_path, sep="\t")
+
+    # One pass over the summary: the annotations of each file, keyed by scan number
+    sources = []
+    for file, subset in df.groupby("new_filename", sort=False):
+        stem = file.split('.')[0]
+        mgf_file_path = os.path.join(base_folder, task, "nf_output", "extracted", "extracted_mgf", f"{stem}.mgf")
+        sources.append((stem, mgf_file_path, _annotation_strings(name, subset)))
+    return sources
+
+
+def insert_mgf_info(task: str, name: str, tsv_file_path: str, base_folder: str = "./downloaded_content", workers=None):
     """
     Insert MGF info into the MGF files based on the TSV summary.
     :param task: task ID for the GNPS2 job. This will be used to construct the MGF file path associated with the task.
-    :param name:
+    :param name: name of the MassQL query, written as MASSQL_ORIGIN.
     :param tsv_file_path: TSV file generated during the MASSQL job. This file contains the information needed to insert the metadata into the MGF files.
     :param base_folder: Folder under which the MGF files are stored. This is usually the same folder where the task zip file was downloaded and extracted.
+    :param workers: number of processes annotating files in parallel. If None, the number of CPUs.
     :return: None
     """
     print(f"Inserting MGF info for task {task}...")
-    df = pd.read_csv(tsv_file_path, sep="\t")
-    files_to_process = df["new_filename"].unique()
-    for file in tqdm(files_to_process, desc="Processing MGF files"):
-        subset = df[df["new_filename"] == file]
-        mgf_file_path = os.path.join(base_folder, task, "nf_output", "extracted", "extracted_mgf", f"{file.split('.')[0]}.mgf")
-        output_mgf_file_path = os.path.join(base_folder, task, f"processed_{file.split('.')[0]}.mgf")
-
-        with open(mgf_file_path, "r") as f, open(output_mgf_file_path, "w") as out_f:
-            for line in f:
-                if line.startswith("SCANS"):
-                    scan_number = line.split("=")[1].strip()
-                    row = subset[subset["new_scan"] == int(scan_number)].iloc[0]
-                    insert_string = (
-                        f"MASSQL_ORIGIN={name}\n"
-                        f"MASSQL_PEPMASS={row.precmz}\n"
-                        f"MASSQL_ORIGINAL_PATH={row.original_path}\n"
-                        f"MASSQL_SCAN={row.scan}\n"
-                        f"MASSQL_NEW_SCAN={row.new_scan}\n"
-                        f"MASSQL_NEW_FILENAME={row.new_filename}\n"
-                        f"MASSQL_I={row.i}\n"
-                    )
-                    out_f.write(insert_string)
-                out_f.write(line)
-
-        print(f"Processed {mgf_file_path}")
+    jobs = [
+        (mgf_file_path, os.path.join(base_folder, task, f"processed_{stem}.mgf"), annotations)
+        for stem, mgf_file_path, annotations in load_annotations(task, name, tsv_file_path, base_folder)
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(annotate_mgf_file, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing MGF files"):
+            output_mgf_file_path, annotated, missing = future.result()
+            if missing:
+                print(f"{len(missing)} spectra of {output_mgf_file_path} have no row in the TSV summary and were not "
+                      f"annotated (e.g. SCANS={missing[0]}).")
+            print(f"Processed {output_mgf_file_path} ({annotated} spectra annotated)")
 
 
 def concatenate_mgf_files(input_folder, output_file):
@@ -141,7 +265,7 @@ def concatenate_mgf_files(input_folder, output_file):
         for mgf_file in processed_files:
             print(f"Adding {mgf_file} to {output_file}...")
             with open(mgf_file, "r") as infile:
-                outfile.write(infile.read())
+                shutil.copyfileobj(infile, outfile, COPY_BUFFER_SIZE)
                 outfile.write("\n")  # Ensure separation between files
     print(f"Concatenation complete. Output written to {output_file}.")
 
@@ -164,27 +288,122 @@ def renumber_mgf_file(input_mgf, output_mgf):
     print(f"Renumbering complete. Output written to {output_mgf}.")
 
 
+def merge_mgf_files(sources, output_file, block_size=COPY_BUFFER_SIZE):
+    """
+    Concatenate MGF files into a single file, inserting the annotation of each spectrum before its SCANS line and
+    renumbering SCANS from 1, in one streaming pass.
+    The files are read in newline-aligned blocks; the bytes between two SCANS lines are copied as they are, so only
+    the SCANS lines themselves are rewritten. The output is the same as insert_mgf_info + concatenate_mgf_files +
+    renumber_mgf_file, without the intermediate files. Line breaks are kept: the rewritten SCANS line, its annotation
+    and the separation between files use the line break of the file (CRLF files stay CRLF).
+    :param sources: iterable of (MGF file path, dict mapping each scan number to its annotation string, or None).
+    :param output_file: Output MGF file.
+    :param block_size: size in bytes of the blocks read from each file.
+    :return: number of spectra (SCANS lines) written.
+    """
+    print(f"Merging MGF files into {output_file}...")
+    scan_number = 0
+    with open(output_file, "wb") as out_f:
+        for mgf_file_path, annotations in sources:
+            encoded = {scan: text.encode() for scan, text in (annotations or {}).items()}
+            missing = 0
+            newline = None
+            separated = False
+            with open(mgf_file_path, "rb") as f:
+                tail = b""
+                while True:
+                    chunk = f.read(block_size)
+                    block = tail + chunk
+                    if chunk:
+                        # Keep the incomplete last line for the next block
+                        cut = block.rfind(b"\n") + 1
+                        block, tail = block[:cut], block[cut:]
+                    if block and newline is None:
+                        first_break = block.find(b"\n")
+                        newline = b"\r\n" if first_break > 0 and block[first_break - 1] == ord("\r") else b"\n"
+                    if block:
+                        view = memoryview(block)
+                        position = 0
+                        for match in SCANS_LINE.finditer(block):
+                            out_f.write(view[position:match.start()])
+                            line_break = match.group(2) or newline
+                            if annotations is not None:
+                                insert = encoded.get(int(match.group(1).split(b"=", 2)[1]))
+                                if insert is None:
+                                    missing += 1
+                                elif line_break == b"\n":
+                                    out_f.write(insert)
+                                else:
+                                    out_f.write(insert.replace(b"\n", line_break))
+                            scan_number += 1
+                            out_f.write(b"SCANS=%d%s" % (scan_number, line_break))
+                            # A SCANS line ending the file without a line break gets the separation one
+                            separated = not match.group(2)
+                            position = match.end()
+                        out_f.write(view[position:])
+                    if not chunk:
+                        break
+            if not separated:
+                out_f.write(newline or b"\n")  # Ensure separation between files
+            if missing:
+                print(f"{missing} spectra of {mgf_file_path} have no row in the TSV summary and were not annotated.")
+            print(f"Added {mgf_file_path} to {output_file}.")
+    print(f"Merge complete. {scan_number} spectra written to {output_file}.")
+    return scan_number
+
+
+def merge_tsv_frames(frames, output_file):
+    """
+    Merge the TSV summaries read from a task archive into a single TSV file.
+    :param frames: list of DataFrames.
+    :param output_file: Output file path for the merged TSV file.
+    :return: output_file, or None if there is nothing to merge.
+    """
+    if not frames:
+        print(f"No TSV files found to merge into {output_file}.")
+        return None
+    pd.concat(frames).to_csv(output_file, sep="\t", index=False)
+    print(f"Merged TSV files into {output_file}.")
+    return output_file
+
+
 def extract_and_merge_tsv(tar_file: str, subfolder: str, output_file: str):
     """
-    Extract the contents of a specific subfolder from a tar file and merge TSV files.
+    Read the TSV files of a specific subfolder of a tar file and merge them. The TSV files are read straight from the
+    archive, without extracting them.
     :param tar_file: Path to the tar file.
-    :param subfolder: Subfolder to extract from the tar file.
+    :param subfolder: Subfolder to read from the tar file.
     :param output_file: Output file path for the merged TSV file.
     """
-    extract_path = extract_results(tar_file, subfolder)
+    frames = []
+    scan_task_archive(tar_file, {subfolder: read_tsv_members(frames)})
+    return merge_tsv_frames(frames, output_file)
 
-    # Merge TSV files
-    full_path = os.path.join(extract_path, subfolder)
-    tsv_files = [f for f in os.listdir(full_path) if f.endswith('.tsv')]
-    if tsv_files:
 
-        merged_df = pd.concat([pd.read_csv(os.path.join(full_path, f), sep="\t") for f in tsv_files])
-        merged_df.to_csv(output_file, sep="\t", index=False)
-        print(f"Merged TSV files into {output_file}.")
-        return output_file
+def process_task_archive(tar_file: str, mgf_subfolder: str, tsv_subfolder: str = None, tsv_output_file: str = None):
+    """
+    Extract the MGF files of a task and, optionally, merge its TSV files, with a single pass over the tar file.
+    :param tar_file: Path to the tar file.
+    :param mgf_subfolder: Subfolder with the MGF files, extracted next to the tar file.
+    :param tsv_subfolder: Subfolder with the TSV files. If None, the TSV files are not read.
+    :param tsv_output_file: Output file path for the merged TSV file.
+    :return: Path of the merged TSV file, or None.
+    """
+    print(f"Extracting results from {tar_file}...")
+    extract_path = os.path.splitext(tar_file)[0]
+    frames = []
+    handlers = {mgf_subfolder: extract_member_to(extract_path)}
+    if tsv_subfolder is not None:
+        handlers[tsv_subfolder] = read_tsv_members(frames)
+
+    counts = scan_task_archive(tar_file, handlers)
+    if counts[mgf_subfolder]:
+        print(f"Extracted {counts[mgf_subfolder]} files of subfolder '{mgf_subfolder}' to '{extract_path}'.")
     else:
-        print(f"No TSV files found in {extract_path}.")
+        print(f"No contents found for subfolder: {mgf_subfolder}")
+    if tsv_subfolder is None:
         return None
+    return merge_tsv_frames(frames, tsv_output_file)
 
 
 if __name__ == "__main__":
@@ -204,39 +423,39 @@ if __name__ == "__main__":
         print(f"Downloading task files: {name} ({task})")
         download_task_zip(task, output_dir=output_dir)
 
+    sources = []
     for name, task in tqdm(tasks.items(), desc="Processing tasks"):
         print(f"Processing task: {name} ({task})")
-        extract_results(
-            f"{output_dir}/{task}.tar",
-            subfolder="nf_output/extracted/extracted_mgf",
-        )
-
-        # optional cleanup step, uncomment the lines below to remove the tar file after extraction
-        # os.remove(f"{output_dir}/{task}.tar")
-        # print(f"Removed {task}.tar")
 
         try:
             tsv_file_path = download_tsv_summary(task, output_dir=output_dir)
+            tsv_subfolder = None
         except requests.exceptions.RequestException as e:
             print(f"Error downloading TSV summary for task {task}: {e}")
             print("Trying to extract tsv files for external merge...")
+            tsv_subfolder = "nf_output/extracted/extracted_tsv"
 
-            tsv_file_path = extract_and_merge_tsv(
-                f"{output_dir}/{task}.tar",
-                subfolder="nf_output/extracted/extracted_tsv",
-                output_file=f"{output_dir}/externally_merged_{task}.tsv"
-            )
-
+        # Single pass over the archive: extract the MGF files and, if needed, merge the TSV files from memory
+        merged_tsv = process_task_archive(
+            f"{output_dir}/{task}.tar",
+            mgf_subfolder="nf_output/extracted/extracted_mgf",
+            tsv_subfolder=tsv_subfolder,
+            tsv_output_file=f"{output_dir}/externally_merged_{task}.tsv",
+        )
+        if tsv_subfolder is not None:
+            tsv_file_path = merged_tsv
 
-        insert_mgf_info(task, name, tsv_file_path, base_folder=output_dir)
+        # optional cleanup step, uncomment the lines below to remove the tar file after extraction
+        # os.remove(f"{output_dir}/{task}.tar")
+        # print(f"Removed {task}.tar")
 
-        os.makedirs("./final_mgf", exist_ok=True)
-        concatenate_mgf_files(
-            output_dir, "./final_mgf/all_concatenated.mgf"
-        )
-        renumber_mgf_file(
-            "./final_mgf/all_concatenated.mgf",
-            "./final_mgf/renumbered_all_concatenated.mgf",
+        sources.extend(
+            (mgf_file_path, annotations)
+            for _, mgf_file_path, annotations in load_annotations(task, name, tsv_file_path, base_folder=output_dir)
         )
 
+    # Annotate, concatenate and renumber all the tasks at once, writing the final MGF file a single time
+    os.makedirs("./final_mgf", exist_ok=True)
+    merge_mgf_files(sources, "./final_mgf/renumbered_all_concatenated.mgf")
+
     print("All tasks processed successfully.")
@@ -0,0 +1,75 @@
+import glob
+import os
+
+import pytest
+
+from massql_mgf_merge import annotate_mgf_file, concatenate_mgf_files, merge_mgf_files, renumber_mgf_file
+
+SPECTRA = {
+    "a": [(3, "BEGIN IONS\nPEPMASS=100.5\nSCANS=3\n101.0 20\n102.0 30\nEND IONS\n"),
+          (7, "BEGIN IONS\nPEPMASS=200.5\nSCANS=7\n201.0 5\nEND IONS\n")],
+    # The last line of this file has no line break
+    "b": [(1, "BEGIN IONS\nPEPMASS=300.5\nSCANS=1\n301.0 7\nEND IONS\n"),
+          (2, "BEGIN IONS\nPEPMASS=400.5\nSCANS=2")],
+}
+
+
+def _annotations(stem):
+    # Scan 7 of file a has no row in the summary
+    return {scan: f"MASSQL_ORIGIN=query\nMASSQL_FILE={stem}\nMASSQL_SCAN={scan}\n"
+            for scan, _ in SPECTRA[stem] if (stem, scan) != ("a", 7)}
+
+
+def _write_mgf_files(folder, newline):
+    for stem, spectra in SPECTRA.items():
+        text = "".join(spectrum for _, spectrum in spectra)
+        with open(os.path.join(folder, f"{stem}.mgf"), "wb") as f:
+            f.write(text.replace("\n", newline).encode())
+
+
+def _pipeline_output(folder):
+    """Output of the three step pipeline: insert_mgf_info (annotate_mgf_file), concatenation and renumbering."""
+    for stem in SPECTRA:
+        annotate_mgf_file(os.path.join(folder, f"{stem}.mgf"), os.path.join(folder, f"processed_{stem}.mgf"),
+                          _annotations(stem))
+    concatenated = os.path.join(folder, "concatenated.mgf.txt")
+    renumbered = os.path.join(folder, "renumbered.mgf.txt")
+    concatenate_mgf_files(folder, concatenated)
+    renumber_mgf_file(concatenated, renumbered)
+    with open(renumbered, "rb") as f:
+        return f.read()
+
+
+def _merged_output(folder, block_size):
+    # Same file order as concatenate_mgf_files
+    stems = [os.path.basename(path)[len("processed_"):-len(".mgf")]
+             for path in glob.glob(f"{folder}/**/*.mgf", recursive=True) if "processed" in path]
+    output_file = os.path.join(folder, "merged.mgf.txt")
+    merge_mgf_files([(os.path.join(folder, f"{stem}.mgf"), _annotations(stem)) for stem in stems], output_file,
+                    block_size=block_size)
+    with open(output_file, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("block_size", [5, 64, 1 << 20])
+def test_merge_is_identical_to_the_pipeline(tmp_path, block_size):
+    _write_mgf_files(tmp_path, "\n")
+    expected = _pipeline_output(tmp_path)
+    assert b"SCANS=4\n" in expected
+    assert _merged_output(tmp_path, block_size) == expected
+
+
+@pytest.mark.parametrize("block_size", [5, 64, 1 << 20])
+def test_merge_keeps_crlf_line_breaks(tmp_path, block_size):
+    _write_mgf_files(tmp_path, "\n")
+    expected = _pipeline_output(tmp_path).replace(b"\n", b"\r\n")
+    for path in glob.glob(f"{tmp_path}/*"):
+        os.remove(path)
+
+    _write_mgf_files(tmp_path, "\r\n")
+    # Only used to give merge_mgf_files the file order of concatenate_mgf_files
+    for stem in SPECTRA:
+        open(os.path.join(tmp_path, f"processed_{stem}.mgf"), "w").close()
+    merged = _merged_output(tmp_path, block_size)
+    assert merged == expected
+    assert b"\n" not in merged.replace(b"\r\n", b"")
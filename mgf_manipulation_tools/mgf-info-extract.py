@@ -1,15 +1,183 @@
 #!/usr/bin/env python3
 """
 MGF Keyword Extractor
-Extracts specific keyword values from MGF files and saves them to a text file.
+Extracts specific keyword values from MGF files and saves them to a text file, or extracts several keywords from
+several MGF files into one table with one row per spectrum.
 """
 
 import argparse
+import csv
+import glob
+import mmap
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
 
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def iter_blocks(buffer, block_size=BLOCK_SIZE):
+    """
+    Split a buffer into blocks that end at a line break, so that no line is cut between two blocks.
+
+    Args:
+        buffer (mmap.mmap): Buffer to split
+        block_size (int): Approximate size of each block in bytes
+
+    Returns:
+        generator: Blocks (bytes)
+    """
+    start = 0
+    size = len(buffer)
+    while start < size:
+        end = min(start + block_size, size)
+        if end < size:
+            newline = buffer.find(b'\n', end)
+            end = size if newline == -1 else newline + 1
+        yield buffer[start:end]
+        start = end
+
+
+def iter_keyword_matches(mgf_file, needles, case_sensitive=False):
+    """
+    Find the lines starting with any of the given byte strings by scanning the raw bytes of a memory-mapped MGF file.
+    The needles are searched as literals in large blocks, and only the matched values are decoded, so the file is
+    never split into lines. For case-insensitive search each block is lower-cased once as a whole.
+
+    Args:
+        mgf_file (str): Path to the MGF input file
+        needles (list): Line prefixes to search for (e.g., [b'TITLE=', b'BEGIN IONS'])
+        case_sensitive (bool): Whether to perform case-sensitive search
+
+    Returns:
+        generator: (index of the matched needle, rest of the line) in file order
+    """
+    if not case_sensitive:
+        needles = [needle.lower() for needle in needles]
+    needle_index = {needle: i for i, needle in enumerate(needles)}
+    pattern = re.compile(b'(' + b'|'.join(re.escape(needle) for needle in needles) + rb')([^\r\n]*)')
+
+    with open(mgf_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for block in iter_blocks(buffer):
+                haystack = block if case_sensitive else block.lower()
+                for match in pattern.finditer(haystack):
+                    position = match.start()
+                    # The needle must start the line (only spaces or tabs before it)
+                    if position and haystack[position - 1] != 10:
+                        line_start = haystack.rfind(b'\n', 0, position) + 1
+                        if haystack[line_start:position].strip(b' \t'):
+                            continue
+                    value = block[match.start(2):match.end(2)]
+                    yield needle_index[match.group(1)], value.decode('utf-8', errors='replace').rstrip()
+
+
+def scan_keyword_values(mgf_file, keyword, case_sensitive=False):
+    """
+    Find the values of a keyword with a single scan of the MGF file (see iter_keyword_matches).
+
+    Args:
+        mgf_file (str): Path to the MGF input file
+        keyword (str): Keyword to search for (e.g., 'USI', 'TITLE', 'CHARGE')
+        case_sensitive (bool): Whether to perform case-sensitive search
+
+    Returns:
+        list: List of extracted values
+    """
+    return [value for _, value in iter_keyword_matches(mgf_file, [keyword.encode('utf-8') + b'='], case_sensitive)]
+
+
+def extract_spectrum_keywords(mgf_file, keywords, case_sensitive=False):
+    """
+    Extract the values of several keywords from an MGF file in a single pass, one row per spectrum.
+
+    Args:
+        mgf_file (str): Path to the MGF input file
+        keywords (list): Keywords to extract (e.g., ['TITLE', 'PEPMASS', 'CHARGE', 'SCANS'])
+        case_sensitive (bool): Whether to perform case-sensitive search
+
+    Returns:
+        list: One list per spectrum with the values of each keyword ('' when the spectrum does not have it)
+    """
+    needles = [b'BEGIN IONS'] + [keyword.encode('utf-8') + b'=' for keyword in keywords]
+    rows = []
+    for index, value in iter_keyword_matches(mgf_file, needles, case_sensitive):
+        if index == 0:
+            rows.append([''] * len(keywords))
+        elif rows and not rows[-1][index - 1]:
+            rows[-1][index - 1] = value
+    return rows
+
+
+def extract_keyword_table(mgf_files, keywords, output_file, case_sensitive=False, workers=1):
+    """
+    Extract several keywords from several MGF files into one table with one row per spectrum.
+    Each file is scanned once for all keywords, and the files are spread over a process pool.
+
+    Args:
+        mgf_files (list): Paths to the MGF input files
+        keywords (list): Keywords to extract
+        output_file (str): Output table path. Saved as Parquet if it ends with '.parquet' (requires pyarrow),
+            otherwise as TSV
+        case_sensitive (bool): Whether to perform case-sensitive search
+        workers (int): Number of processes
+
+    Returns:
+        int: Number of spectra written
+    """
+    header = ['file', 'spectrum_index'] + list(keywords)
+    columns = {name: [] for name in header}
+
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        # map keeps the order of the input files
+        results = executor.map(extract_spectrum_keywords, mgf_files, repeat(keywords), repeat(case_sensitive))
+        for mgf_file, rows in zip(mgf_files, results):
+            print(f"Extracted {len(rows)} spectra from '{mgf_file}'")
+            columns['file'].extend([mgf_file] * len(rows))
+            columns['spectrum_index'].extend(range(1, len(rows) + 1))
+            for i, keyword in enumerate(keywords):
+                columns[keyword].extend(row[i] for row in rows)
+
+    n_rows = len(columns['file'])
+    if output_file.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.table(columns), output_file)
+    else:
+        with open(output_file, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(zip(*columns.values()))
+    print(f"Extracted {len(keywords)} keywords for {n_rows} spectra and saved to '{output_file}'")
+    return n_rows
+
+
+def expand_inputs(patterns):
+    """
+    Expand file paths and glob patterns into a list of existing files, keeping the given order.
+
+    Args:
+        patterns (list): File paths or glob patterns (e.g., 'data/*.mgf')
+
+    Returns:
+        list: File paths
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        for path in matches or [pattern]:
+            if path not in files:
+                files.append(path)
+    return files
+
+
 def extract_keyword_values(mgf_file, keyword, output_file=None, case_sensitive=False):
     """
     Extract values for a specific keyword from an MGF file.
@@ -23,27 +191,8 @@ def extract_keyword_values(mgf_file, keyword, output_file=None, case_sensitive=F
     Returns:
         list: List of extracted values
     """
-    values = []
-
     try:
-        with open(mgf_file, 'r', encoding='utf-8') as f:
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-
-                # Skip empty lines
-                if not line:
-                    continue
-
-                # Check if line contains the keyword
-                if case_sensitive:
-                    if line.startswith(keyword + '='):
-                        value = line[len(keyword) + 1:]
-                        values.append(value)
-                else:
-                    if line.upper().startswith(keyword.upper() + '='):
-                        value = line[len(keyword) + 1:]
-                        values.append(value)
-
+        values = scan_keyword_values(mgf_file, keyword, case_sensitive)
     except FileNotFoundError:
         print(f"Error: File '{mgf_file}' not found.")
         return []
@@ -55,8 +204,7 @@ def extract_keyword_values(mgf_file, keyword, output_file=None, case_sensitive=F
     if output_file:
         try:
             with open(output_file, 'w', encoding='utf-8') as f:
-                for value in values:
-                    f.write(value + '\n')
+                f.writelines(value + '\n' for value in values)
             print(f"Extracted {len(values)} values and saved to '{output_file}'")
         except Exception as e:
             print(f"Error writing to output file '{output_file}': {e}")
@@ -73,47 +221,82 @@ Examples:
   python mgf_extractor.py input.mgf USI
   python mgf_extractor.py input.mgf TITLE -o titles.txt
   python mgf_extractor.py input.mgf CHARGE -o charges.txt --case-sensitive
+  python mgf_extractor.py input.mgf TITLE -o titles.tsv --table
+  python mgf_extractor.py 'data/*.mgf' other.mgf -k TITLE PEPMASS CHARGE SCANS -o spectra.tsv -w 8
+  python mgf_extractor.py 'data/*.mgf' -k TITLE SCANS -o spectra.parquet
         """
     )
 
-    parser.add_argument('mgf_file', help='Path to the MGF input file')
-    parser.add_argument('keyword', help='Keyword to extract (e.g., USI, TITLE, CHARGE)')
-    parser.add_argument('-o', '--output', help='Output text file path (optional)')
+    parser.add_argument('inputs', nargs='+',
+                        help='MGF input file(s) or glob pattern(s), followed by the keyword to extract when '
+                             '--keywords is not used')
+    parser.add_argument('-k', '--keywords', nargs='+',
+                        help='Keywords to extract into one table with one row per spectrum (e.g., TITLE PEPMASS)')
+    parser.add_argument('-o', '--output', help='Output text file path (optional). For tables, .tsv or .parquet')
+    parser.add_argument('--table', action='store_true',
+                        help='Save a single keyword of a single file as a table (one row per spectrum) instead of '
+                             'the list of its values. Always the case with --keywords or several files')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes used when extracting from several files')
     parser.add_argument('--case-sensitive', action='store_true',
                         help='Perform case-sensitive keyword matching')
 
     args = parser.parse_args()
 
-    # Validate input file
-    if not os.path.exists(args.mgf_file):
-        print(f"Error: Input file '{args.mgf_file}' does not exist.")
+    # Without --keywords the last positional argument is the keyword (python mgf_extractor.py input.mgf USI)
+    if args.keywords:
+        patterns, keywords = args.inputs, args.keywords
+    else:
+        if len(args.inputs) < 2:
+            parser.error('the keyword to extract is required')
+        patterns, keywords = args.inputs[:-1], args.inputs[-1:]
+    mgf_files = expand_inputs(patterns)
+
+    # Validate input files
+    missing = [mgf_file for mgf_file in mgf_files if not os.path.exists(mgf_file)]
+    if missing:
+        for mgf_file in missing:
+            print(f"Error: Input file '{mgf_file}' does not exist.")
         sys.exit(1)
 
-    # Generate output filename if not provided
     output_file = args.output
+    # A single keyword of a single file keeps the plain list of values, whatever the output extension
+    if args.table or args.keywords or len(mgf_files) > 1:
+        extract_keyword_table(
+            mgf_files,
+            keywords,
+            output_file or 'mgf_keywords.tsv',
+            args.case_sensitive,
+            min(args.workers, len(mgf_files))
+        )
+        return
+
+    mgf_file, keyword = mgf_files[0], keywords[0]
+
+    # Generate output filename if not provided
     if not output_file:
-        mgf_path = Path(args.mgf_file)
-        output_file = mgf_path.stem + f'_{args.keyword.lower()}_values.txt'
+        mgf_path = Path(mgf_file)
+        output_file = mgf_path.stem + f'_{keyword.lower()}_values.txt'
 
     # Extract values
     values = extract_keyword_values(
-        args.mgf_file,
-        args.keyword,
+        mgf_file,
+        keyword,
         output_file,
         args.case_sensitive
     )
 
     # Print results
     if values:
-        print(f"\nFound {len(values)} values for keyword '{args.keyword}':")
+        print(f"\nFound {len(values)} values for keyword '{keyword}':")
         for i, value in enumerate(values[:10], 1):  # Show first 10 values
             print(f"  {i}: {value}")
 
         if len(values) > 10:
             print(f"  ... and {len(values) - 10} more values")
     else:
-        print(f"No values found for keyword '{args.keyword}' in '{args.mgf_file}'")
+        print(f"No values found for keyword '{keyword}' in '{mgf_file}'")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
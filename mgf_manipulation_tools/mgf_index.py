@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+MGF Offset Index
+Records the byte offsets of every BEGIN IONS ... END IONS block of an MGF file, keyed by ordinal, SCANS and TITLE,
+so any spectrum can be read with a single seek instead of scanning the whole file.
+The index is saved as a SQLite sidecar ('<file>.mgf.idx.sqlite') and rebuilt when the size or modification time of
+the MGF file changes.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import sqlite3
+import threading
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx.sqlite'
+LINE_PATTERN = re.compile(rb'^(BEGIN IONS|END IONS|SCANS=|TITLE=)([^\r\n]*)', re.MULTILINE)
+
+
+def index_path_for(mgf_file, index_dir=None):
+    """
+    Get the path of the sidecar index of an MGF file.
+
+    Args:
+        mgf_file (str): Path to the MGF file
+        index_dir (str): Folder to keep the index in. If None, the index is saved next to the MGF file
+
+    Returns:
+        str: Path of the index file
+    """
+    if index_dir is None:
+        return mgf_file + INDEX_SUFFIX
+    return os.path.join(index_dir, os.path.basename(mgf_file) + INDEX_SUFFIX)
+
+
+def _file_signature(mgf_file):
+    stat = os.stat(mgf_file)
+    return str(stat.st_size), str(stat.st_mtime_ns)
+
+
+def scan_blocks(mgf_file):
+    """
+    Find the spectrum blocks of an MGF file with one pass over the memory-mapped file.
+
+    Args:
+        mgf_file (str): Path to the MGF file
+
+    Returns:
+        generator: (ordinal, start offset, end offset, SCANS or None, TITLE or None) for each spectrum
+    """
+    with open(mgf_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            ordinal, start, scans, title = 0, None, None, None
+            for match in LINE_PATTERN.finditer(buffer):
+                key = match.group(1)
+                if key == b'BEGIN IONS':
+                    start, scans, title = match.start(), None, None
+                elif start is None:
+                    continue
+                elif key == b'END IONS':
+                    end = buffer.find(b'\n', match.end())
+                    end = len(buffer) if end == -1 else end + 1
+                    yield ordinal, start, end, scans, title
+                    ordinal += 1
+                    start = None
+                elif key == b'SCANS=' and scans is None:
+                    scans = match.group(2).decode('utf-8', errors='replace').strip()
+                elif key == b'TITLE=' and title is None:
+                    title = match.group(2).decode('utf-8', errors='replace').strip()
+
+
+def build_index(mgf_file, index_path):
+    """
+    Build the SQLite offset index of an MGF file. The index is written to a temporary file and moved into place
+    once complete.
+
+    Args:
+        mgf_file (str): Path to the MGF file
+        index_path (str): Path of the index file
+    """
+    size, mtime = _file_signature(mgf_file)
+    tmp_path = f'{index_path}.tmp-{os.getpid()}'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        with connection:
+            connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE spectra (ordinal INTEGER PRIMARY KEY, start INTEGER, end INTEGER, '
+                               'scans TEXT, title TEXT)')
+            connection.executemany('INSERT INTO spectra VALUES (?, ?, ?, ?, ?)', scan_blocks(mgf_file))
+            connection.execute('CREATE INDEX spectra_scans ON spectra (scans)')
+            connection.execute('CREATE INDEX spectra_title ON spectra (title)')
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(INDEX_VERSION)), ('mgf_size', size), ('mgf_mtime_ns', mtime)])
+    finally:
+        connection.close()
+    os.replace(tmp_path, index_path)
+
+
+def _index_is_valid(mgf_file, index_path):
+    if not os.path.exists(index_path):
+        return False
+    try:
+        connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        try:
+            meta = dict(connection.execute('SELECT key, value FROM meta'))
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    size, mtime = _file_signature(mgf_file)
+    return meta == {'version': str(INDEX_VERSION), 'mgf_size': size, 'mgf_mtime_ns': mtime}
+
+
+class MgfIndex:
+    """
+    Random access to the spectra of an MGF file through its persistent offset index.
+
+    Example:
+        index = MgfIndex('library.mgf')
+        block = index.read_block(index.find_scan('1234'))
+    """
+
+    def __init__(self, mgf_file, index_dir=None, rebuild=False):
+        self.mgf_file = mgf_file
+        self.index_path = index_path_for(mgf_file, index_dir)
+        if rebuild or not _index_is_valid(mgf_file, self.index_path):
+            build_index(mgf_file, self.index_path)
+        # Read-only connection, safe to share between the threads of a server (e.g. Streamlit)
+        self._connection = sqlite3.connect(f'file:{self.index_path}?mode=ro', uri=True, check_same_thread=False)
+        self._file = open(mgf_file, 'rb')
+        self._file_lock = threading.Lock()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM spectra').fetchone()[0]
+
+    def entries(self):
+        """
+        List the indexed spectra in file order.
+
+        Returns:
+            list: (ordinal, SCANS or None, TITLE or None) for each spectrum
+        """
+        return self._connection.execute('SELECT ordinal, scans, title FROM spectra ORDER BY ordinal').fetchall()
+
+    def _find(self, column, value):
+        row = self._connection.execute(
+            f'SELECT start, end FROM spectra WHERE {column} = ? ORDER BY ordinal LIMIT 1', (value,)).fetchone()
+        return tuple(row) if row else None
+
+    def find_scan(self, scan):
+        """Offsets (start, end) of the first spectrum with SCANS=scan, or None."""
+        return self._find('scans', str(scan).strip())
+
+    def find_title(self, title):
+        """Offsets (start, end) of the first spectrum with TITLE=title, or None."""
+        return self._find('title', title.strip())
+
+    def find_ordinal(self, ordinal):
+        """Offsets (start, end) of the spectrum at position `ordinal` (0-based) in the file, or None."""
+        return self._find('ordinal', int(ordinal))
+
+    def read_block(self, offsets):
+        """
+        Read the text of a spectrum block.
+
+        Args:
+            offsets (tuple): (start, end) as returned by the find_* methods
+
+        Returns:
+            str: The BEGIN IONS ... END IONS block, or None if offsets is None
+        """
+        if offsets is None:
+            return None
+        start, end = offsets
+        with self._file_lock:
+            self._file.seek(start)
+            block = self._file.read(end - start)
+        return block.decode('utf-8', errors='replace')
+
+    def close(self):
+        self._connection.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the offset index of MGF files")
+    parser.add_argument('mgf_files', nargs='+', help='MGF files to index')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the index even if it is up to date')
+    args = parser.parse_args()
+
+    for mgf_file in args.mgf_files:
+        with MgfIndex(mgf_file, rebuild=args.rebuild) as index:
+            print(f"Indexed {len(index)} spectra of '{mgf_file}' in '{index.index_path}'")
+
+
+if __name__ == "__main__":
+    main()
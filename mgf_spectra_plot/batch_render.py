@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Batch Spectrum Rendering
+Render the spectra of an MGF file (all of them, or a list of scans) to SVG or PNG files without the Streamlit app.
+The spectra are located with the MGF offset index and rendered by a pool of processes; each process keeps one open
+index and reuses a single matplotlib figure, and the images are written straight from memory.
+
+Example:
+    python batch_render.py library.mgf -o plots
+    python batch_render.py library.mgf -o plots --scans 12 15 20 --format png -w 8
+    python batch_render.py library.mgf -o plots --scan-list scans.txt
+    python batch_render.py library.mgf -o plots --max-peaks 50
+"""
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+from tqdm import tqdm
+
+from draw import generate_figure
+from utils import MgfIndex, build_spectrum, calculate_dynamic_kwargs, parse_block
+
+DEFAULT_KWARGS = {
+    "width": 10,
+    "height": 6,
+    "annotation_rotation": 90,
+    "grid": True,
+    "annotate_precision": 4,
+}
+
+# Per-process state, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(mgf_path, output_dir, extension, kwargs, max_peaks=None):
+    fig, ax = plt.subplots(figsize=(kwargs["width"], kwargs["height"]))
+    _worker.update(index=MgfIndex(mgf_path), fig=fig, ax=ax, output_dir=output_dir, extension=extension,
+                   kwargs=kwargs, max_peaks=max_peaks)
+
+
+def _spectrum_key(ordinal, scans):
+    """Name of a spectrum in the output: its SCANS value, or its position in the file if it has none."""
+    return scans if scans else f"index{ordinal}"
+
+
+def _render(entry):
+    ordinal, scans, title = entry
+    key = _spectrum_key(ordinal, scans)
+    try:
+        index = _worker["index"]
+        scan_content = parse_block(index.read_block(index.find_ordinal(ordinal)))
+        identifier = f"scan:{scans}" if scans else f"index:{ordinal}"
+        spectrum = build_spectrum(scan_content, identifier, _worker["max_peaks"])
+
+        mz_min, mz_max, max_intensity = calculate_dynamic_kwargs(spectrum.mz, spectrum.intensity)
+        kwargs = dict(_worker["kwargs"], mz_min=mz_min, mz_max=mz_max, max_intensity=max_intensity,
+                      usi1=f"{title} ({identifier})" if title else identifier)
+
+        image_buffer = generate_figure(spectrum, extension=_worker["extension"], fig=_worker["fig"], ax=_worker["ax"],
+                                       **kwargs)
+        path = os.path.join(_worker["output_dir"], f"spectrum_{key}.{_worker['extension']}")
+        with open(path, "wb") as f:
+            f.write(image_buffer.getbuffer())
+        return key, path, None
+    except Exception as e:
+        return key, None, e
+
+
+def select_entries(index: MgfIndex, scans=None) -> tuple:
+    """
+    Select the spectra to render.
+    :param index: MgfIndex of the MGF file
+    :param scans: list of SCANS values. If None, every spectrum of the file is selected
+    :return: tuple of (list of (ordinal, SCANS, TITLE) entries, list of the requested scans that were not found)
+    """
+    entries = index.entries()
+    if scans is None:
+        return entries, []
+
+    # The first spectrum of each scan number wins, as in MgfIndex.find_scan
+    by_scan = {}
+    for entry in entries:
+        if entry[1] is not None:
+            by_scan.setdefault(entry[1], entry)
+    wanted = list(dict.fromkeys(str(scan).strip() for scan in scans))
+    return [by_scan[scan] for scan in wanted if scan in by_scan], [scan for scan in wanted if scan not in by_scan]
+
+
+def render_spectra(mgf_path: str, output_dir: str, scans=None, extension="svg", workers=1, kwargs=None,
+                   max_peaks=None) -> list:
+    """
+    Render spectra of an MGF file to image files.
+    :param mgf_path: path to the MGF file
+    :param output_dir: folder where the images are saved as 'spectrum_<scan>.<extension>'
+    :param scans: list of SCANS values to render. If None, every spectrum is rendered
+    :param extension: image format ('svg' or 'png')
+    :param workers: number of rendering processes
+    :param kwargs: plotting settings overriding DEFAULT_KWARGS. The m/z and intensity limits are computed per spectrum
+    :param max_peaks: plot only this many peaks of each spectrum (see utils.sort_and_filter_by_intensity). If None, all
+    :return: list of (scan, image path or None, exception or None), in file order
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    kwargs = dict(DEFAULT_KWARGS, **(kwargs or {}))
+
+    # Build (or validate) the index once here, so the workers only open it
+    with MgfIndex(mgf_path) as index:
+        entries, missing = select_entries(index, scans)
+    results = [(scan, None, KeyError(f"Scan {scan} not found in the MGF file.")) for scan in missing]
+
+    init_args = (mgf_path, output_dir, extension, kwargs, max_peaks)
+    if workers <= 1:
+        _init_worker(*init_args)
+        try:
+            results.extend(_render(entry) for entry in tqdm(entries, desc="Rendering spectra"))
+        finally:
+            _worker["index"].close()
+            plt.close(_worker["fig"])
+            _worker.clear()
+        return results
+
+    chunksize = max(1, min(64, len(entries) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args) as executor:
+        results.extend(tqdm(executor.map(_render, entries, chunksize=chunksize), total=len(entries),
+                            desc="Rendering spectra"))
+    return results
+
+
+def read_scan_list(path: str) -> list:
+    """Read scan numbers from a text file, one per line (blank lines are ignored)."""
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render the spectra of an MGF file to SVG or PNG images")
+    parser.add_argument("mgf_file", help="MGF file")
+    parser.add_argument("-o", "--output", default="spectra_plots", help="Output folder (default: spectra_plots)")
+    parser.add_argument("--scans", nargs="+", help="Scan numbers to render (default: all spectra)")
+    parser.add_argument("--scan-list", help="Text file with the scan numbers to render, one per line")
+    parser.add_argument("--format", choices=["svg", "png"], default="svg", help="Image format (default: svg)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of rendering processes (default: number of CPUs)")
+    parser.add_argument("--max-peaks", type=int,
+                        help="Plot only the N most intense peaks, keeping one peak per nominal m/z (default: all)")
+    args = parser.parse_args()
+
+    scans = None
+    if args.scans or args.scan_list:
+        scans = list(args.scans or []) + (read_scan_list(args.scan_list) if args.scan_list else [])
+
+    results = render_spectra(args.mgf_file, args.output, scans=scans, extension=args.format, workers=args.workers,
+                             max_peaks=args.max_peaks)
+    failed = [(scan, error) for scan, _, error in results if error is not None]
+    for scan, error in failed:
+        print(f"Failed to render scan {scan}: {error}")
+    print(f"Rendered {len(results) - len(failed)} spectra to '{args.output}' ({len(failed)} failed)")
+
+
+if __name__ == "__main__":
+    main()
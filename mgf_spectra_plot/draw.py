@@ -1,10 +1,11 @@
-import gc
 import io
-from typing import Any, List
+from typing import Any, List, Optional
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
 from spectrum_utils import plot as sup, spectrum as sus
 
 USI_SERVER = "https://metabolomics-usi.ucsd.edu/"
@@ -13,7 +14,8 @@ plt.rcParams["svg.fonttype"] = "none"
 
 
 def generate_figure(
-        spectrum: sus.MsmsSpectrum, extension: str, **kwargs: Any
+        spectrum: sus.MsmsSpectrum, extension: str, fig: Optional[Figure] = None, ax: Optional[Axes] = None,
+        **kwargs: Any
 ) -> io.BytesIO:
     """
     Generate a spectrum plot.
@@ -24,6 +26,11 @@ def generate_figure(
         The spectrum to be plotted.
     extension : str
         Image format.
+    fig : Optional[Figure]
+        Figure to draw on. If given with `ax`, the axes are cleared and reused and the figure is kept open, which
+        avoids creating a new figure for every spectrum when rendering many of them.
+    ax : Optional[Axes]
+        Axes to draw on (see `fig`).
     kwargs : Any
         Plotting settings.
 
@@ -34,7 +41,12 @@ def generate_figure(
     """
     usi = spectrum.identifier
 
-    fig, ax = plt.subplots(figsize=(kwargs["width"], kwargs["height"]))
+    reuse = fig is not None and ax is not None
+    if reuse:
+        ax.clear()
+        fig.set_size_inches(kwargs["width"], kwargs["height"])
+    else:
+        fig, ax = plt.subplots(figsize=(kwargs["width"], kwargs["height"]))
 
     sup.spectrum(
         spectrum,
@@ -83,11 +95,10 @@ def generate_figure(
     subtitle.set_url(f"{USI_SERVER}spectrum/?usi1={usi}")
 
     buf = io.BytesIO()
-    plt.savefig(buf, bbox_inches="tight", format=extension)
+    fig.savefig(buf, bbox_inches="tight", format=extension)
     buf.seek(0)
-    fig.clear()
-    plt.close(fig)
-    gc.collect()
+    if not reuse:
+        plt.close(fig)
 
     return buf
 
@@ -110,11 +121,16 @@ def parse_tsv_to_spectrum(tsv_string, precursor_mz, precursor_charge, identifier
     sus.MsmsSpectrum
         The spectrum object created from the TSV data.
     """
-    # Parse the TSV string into a NumPy array
+    # Parse the TSV string into a NumPy array, skipping the header line if there is one
     lines = tsv_string.strip().split("\n")
     mz, intensity = [], []
-    for line in lines[1:]:  # Skip the header
-        mz_value, intensity_value = map(float, line.split(peaks_sep))
+    for i, line in enumerate(lines):
+        try:
+            mz_value, intensity_value = map(float, line.split(peaks_sep))
+        except ValueError:
+            if i == 0:
+                continue
+            raise
         mz.append(mz_value)
         intensity.append(intensity_value)
 
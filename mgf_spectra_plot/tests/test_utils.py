@@ -0,0 +1,47 @@
+import numpy as np
+
+import utils
+from usi_cache import UsiCache
+from utils import build_spectrum, sort_and_filter_by_intensity
+
+MZ = np.array([100.1, 99.8, 150.0, 200.2, 200.4, 250.0, 300.0])
+INTENSITY = np.array([10.0, 50.0, 5.0, 30.0, 80.0, 20.0, 40.0])
+
+
+def test_keeps_the_most_intense_peaks_sorted_by_mz():
+    mz, intensity = sort_and_filter_by_intensity(MZ, INTENSITY, max_peaks=3)
+    assert mz.tolist() == [99.8, 200.4, 300.0]
+    assert intensity.tolist() == [50.0, 80.0, 40.0]
+
+
+def test_keeps_one_peak_per_nominal_mz():
+    mz, intensity = sort_and_filter_by_intensity(MZ, INTENSITY, max_peaks=10)
+    # 100.1 and 99.8 both round to 100, 200.2 and 200.4 to 200: only the most intense of each pair is kept
+    assert mz.tolist() == [99.8, 150.0, 200.4, 250.0, 300.0]
+    assert intensity.tolist() == [50.0, 5.0, 80.0, 20.0, 40.0]
+
+
+def test_without_max_peaks_the_peaks_are_unchanged():
+    mz, intensity = sort_and_filter_by_intensity(MZ, INTENSITY)
+    assert mz.tolist() == MZ.tolist()
+    assert intensity.tolist() == INTENSITY.tolist()
+    assert len(sort_and_filter_by_intensity(MZ, INTENSITY, max_peaks=0)[0]) == 0
+
+
+def test_build_spectrum_applies_max_peaks():
+    scan_content = {'precmz': 400.0, 'charge': None, 'mz': MZ, 'intensity': INTENSITY}
+    spectrum = build_spectrum(scan_content, 'scan:1', max_peaks=2)
+    assert spectrum.mz.tolist() == [99.8, 200.4]
+
+
+def test_download_spectra_json_has_the_same_fields_with_and_without_cache(tmp_path, monkeypatch):
+    response = {'precursor_mz': 400.5, 'precursor_charge': 2, 'peaks': [[100.0, 5.0], [200.0, 7.0]],
+                'splash': 'splash10-xyz'}
+    monkeypatch.setattr(utils, '_request_spectra_json', lambda usi: dict(response))
+    with UsiCache(str(tmp_path / 'cache.sqlite')) as cache:
+        monkeypatch.setattr(utils, 'default_cache', lambda: cache)
+        miss = utils.download_spectra_json('mzspec:X:a:scan:1')
+        hit = utils.download_spectra_json('mzspec:X:a:scan:1')
+    uncached = utils.download_spectra_json('mzspec:X:a:scan:1', use_cache=False)
+    assert miss == hit == uncached
+    assert miss == {'precursor_mz': 400.5, 'precursor_charge': 2, 'peaks': [[100.0, 5.0], [200.0, 7.0]], 'n_peaks': 2}
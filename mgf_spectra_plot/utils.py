@@ -1,40 +1,97 @@
+import io
+import os
+import sys
+
+import numpy as np
 import requests
 
 from draw import generate_figure
 from spectrum_utils import spectrum as sus
 from pyteomics import mgf
 
+# The MGF offset index and the USI cache are shared with the other tools of the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'mgf_manipulation_tools'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prec_mz_extraction'))
+from mgf_index import MgfIndex
+from usi_cache import default_cache, json_from_record, record_from_json
 
-def download_spectra_json(usi: str) -> dict | None:
-    download_url = f"https://metabolomics-usi.gnps2.org/json/?usi1={usi}"
-    response = requests.get(download_url)
-    if response.status_code == 200:
-        json_content = response.json()
-        return json_content
-    else:
-        print(f"Failed to download file: {response.status_code}")
+
+def _request_spectra_json(usi: str) -> dict:
+    response = requests.get("https://metabolomics-usi.gnps2.org/json/", params={"usi1": usi})
+    response.raise_for_status()
+    return response.json()
+
+
+def download_spectra_json(usi: str, use_cache=True) -> dict | None:
+    """
+    Get the JSON (precursor m/z, charge and peaks) of a USI from the metabolomics USI resolver.
+    The result has the same fields whether it comes from the cache or from the resolver.
+    :param usi: USI of the spectrum
+    :param use_cache: read through the local USI cache shared with prec_mz_extraction (see usi_cache.py)
+    :return: dict with 'precursor_mz', 'precursor_charge', 'peaks' ([[mz, intensity], ...]) and 'n_peaks', or None if
+    the request failed
+    """
+    try:
+        if use_cache:
+            data = default_cache().fetch(usi, _request_spectra_json)
+        else:
+            data = _request_spectra_json(usi)
+    except requests.RequestException as e:
+        print(f"Failed to download file: {e}")
         return None
+    return json_from_record(*record_from_json(data))
 
 
-def access_scan(mgf_path: str, scan_num: str) -> dict | None:
+def access_scan(mgf_path: str, scan_num: str, index: MgfIndex = None) -> dict | None:
     """
     Access a scan number within an MGF file.
+    The spectrum is located with the persistent offset index of the file (see mgf_manipulation_tools/mgf_index.py),
+    so only its own block is read and parsed.
     :param mgf_path: path to the MGF file
     :param scan_num: Scan number to retrieve
-    :return: a dict containing the spectrum information
+    :param index: an already opened MgfIndex of the file. If None, the index is opened for this call only
+    :return: a dict with the precursor m/z ('precmz'), the charge ('charge', None if missing) and the peaks as numpy
+    arrays ('mz' and 'intensity')
     """
-    mgf_contents = mgf.IndexedMGF(mgf_path, index_by_scans=True)
-    try:
-        spectrum = mgf_contents.get_spectrum(scan_num)
-        result = dict(zip(spectrum["m/z array"], spectrum["intensity array"]))
-        peaks_string = "\n".join([f"{mz}\t{inten}" for mz, inten in result.items()])
-        precmz = spectrum["params"].get("pepmass")[0]
-        charge = spectrum["params"].get("charge")[0]
-        return {'precmz': precmz, 'charge': charge, 'peaks': peaks_string}
-
-    except KeyError:
+    if index is None:
+        with MgfIndex(mgf_path) as index:
+            block = index.read_block(index.find_scan(scan_num))
+    else:
+        block = index.read_block(index.find_scan(scan_num))
+    if block is None:
         print(f"Scan {scan_num} not found in the MGF file.")
         return None
+    return parse_block(block)
+
+
+def parse_block(block: str) -> dict:
+    """
+    Parse the text of one BEGIN IONS ... END IONS block.
+    :param block: spectrum block, as returned by MgfIndex.read_block
+    :return: same dict as access_scan
+    """
+    spectrum = next(iter(mgf.MGF(io.StringIO(block))))
+    precmz = spectrum["params"].get("pepmass")[0]
+    charge = spectrum["params"].get("charge")
+    return {
+        'precmz': precmz,
+        'charge': charge[0] if charge else None,
+        'mz': np.asarray(spectrum["m/z array"], dtype=np.float64),
+        'intensity': np.asarray(spectrum["intensity array"], dtype=np.float64),
+    }
+
+
+def build_spectrum(scan_content: dict, identifier: str, max_peaks=None) -> sus.MsmsSpectrum:
+    """
+    Create a sus.MsmsSpectrum straight from the arrays returned by access_scan.
+    :param scan_content: dict returned by access_scan
+    :param identifier: spectrum identifier (e.g. 'scan:1')
+    :param max_peaks: keep only this many peaks (see sort_and_filter_by_intensity). If None, all peaks are kept
+    :return: sus.MsmsSpectrum
+    """
+    charge = int(scan_content['charge']) if scan_content['charge'] is not None else 1
+    mz, intensity = sort_and_filter_by_intensity(scan_content['mz'], scan_content['intensity'], max_peaks)
+    return sus.MsmsSpectrum(identifier, float(scan_content['precmz']), charge, mz, intensity)
 
 
 def parse_usi(usi: str) -> dict:
@@ -55,56 +112,56 @@ def parse_usi(usi: str) -> dict:
     }
 
 
-def sort_and_filter_by_intensity(peaks_string, max_peaks=None):
-    if max_peaks is not None:
-        lines = peaks_string.replace('mz\tintensity', '').strip().split('\n')
-        pairs = [tuple(map(float, line.split('\t'))) for line in lines if line.strip()]
-
-        # Create a dictionary to store the most intense peak for each rounded m/z
-        peak_dict = {}
-        for mz, intensity in pairs:
-            mz_rounded = round(mz)
-            if mz_rounded not in peak_dict or intensity > peak_dict[mz_rounded][1]:
-                peak_dict[mz_rounded] = (mz, intensity)
+def sort_and_filter_by_intensity(mz, intensity, max_peaks=None):
+    """
+    Keep the most intense peak of each nominal (rounded) m/z, then the `max_peaks` most intense of those.
+    :param mz: m/z array
+    :param intensity: intensity array
+    :param max_peaks: number of peaks to keep. If None, the peaks are returned unchanged
+    :return: tuple of (m/z, intensity) arrays sorted by m/z
+    """
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    if max_peaks is None:
+        return mz, intensity
 
-        # Get the list of most intense peaks per rounded m/z and sort by intensity
-        unique_peaks = list(peak_dict.values())
-        sorted_peaks = sorted(unique_peaks, key=lambda x: x[1], reverse=True)[:max_peaks + 1]
+    # Sort by rounded m/z and then by decreasing intensity, so the first peak of each rounded m/z is the most intense
+    rounded = np.round(mz)
+    order = np.lexsort((-intensity, rounded))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = rounded[order][1:] != rounded[order][:-1]
+    unique = order[first]
 
-        # Sort the final result by m/z
-        sorted_by_mz = sorted(sorted_peaks, key=lambda x: x[0])
-        filtered_peaks = '\n'.join(f"{mz}\t{intensity}" for mz, intensity in sorted_by_mz)
-    else:
-        filtered_peaks = peaks_string
+    if len(unique) > max_peaks:
+        top = np.argpartition(-intensity[unique], max_peaks - 1)[:max_peaks] if max_peaks > 0 else []
+        unique = unique[top]
 
-    return filtered_peaks
+    unique = unique[np.argsort(mz[unique], kind='stable')]
+    return mz[unique], intensity[unique]
 
 
 def draw_spectrum(spectrum: sus.MsmsSpectrum, kwargs: dict):
+    # The SVG is kept in memory, so concurrent sessions do not overwrite each other's plot
     image_buffer = generate_figure(spectrum, extension="svg", **kwargs)
-    # Save or display the SVG
-    with open("spectrum_plot.svg", "wb") as f:
-        f.write(image_buffer.getvalue())
-    svg_file_path = "spectrum_plot.svg"
-    with open(svg_file_path, "r") as f:
-        svg_content = f.read()
-
-    return svg_content
+    return image_buffer.getvalue().decode("utf-8")
 
 
-def calculate_dynamic_kwargs(peaks_string, margin_mz=50, margin_intensity=10, peaks_sep="\t"):
-    lines = peaks_string.strip().split("\n")[1:]  # Skip the header
-    mz_values = []
-    intensity_values = []
-
-    for line in lines:
-        mz, intensity = map(float, line.split(peaks_sep))
-        mz_values.append(mz)
-        intensity_values.append(intensity)
+def calculate_dynamic_kwargs(mz, intensity, margin_mz=50, margin_intensity=10):
+    """
+    Calculate the default plot limits of a spectrum.
+    :param mz: m/z array
+    :param intensity: intensity array
+    :param margin_mz: margin added on both sides of the m/z range
+    :param margin_intensity: margin (in %) added above the most intense peak
+    :return: tuple of (m/z min, m/z max, max intensity in %)
+    """
+    if len(mz) == 0:
+        return 0.0, float(margin_mz), 100.0 + margin_intensity
 
-    mz_min = max(0, min(mz_values) - margin_mz)
-    mz_max = max(mz_values) + margin_mz
-    max_intensity = (max(intensity_values) / max(intensity_values) * 100) + margin_intensity
+    mz_min = max(0.0, float(np.min(mz)) - margin_mz)
+    mz_max = float(np.max(mz)) + margin_mz
+    # Intensities are plotted relative to the base peak
+    max_intensity = (100.0 if np.max(intensity) > 0 else 0.0) + margin_intensity
 
     return mz_min, mz_max, max_intensity
 
@@ -1,7 +1,26 @@
+import os
+
 import streamlit as st
 
 from draw import *
-from utils import access_scan, draw_spectrum, calculate_dynamic_kwargs
+from utils import MgfIndex, access_scan, build_spectrum, draw_spectrum, calculate_dynamic_kwargs
+
+# The file modification time is part of the cache keys, so the caches are invalidated when the MGF file changes
+@st.cache_resource(max_entries=8)
+def open_index(mgf_path: str, mtime_ns: int) -> MgfIndex:
+    return MgfIndex(mgf_path)
+
+
+@st.cache_data(max_entries=256)
+def load_scan(mgf_path: str, mtime_ns: int, scan_number: str) -> dict | None:
+    return access_scan(mgf_path, scan_number, index=open_index(mgf_path, mtime_ns))
+
+
+@st.cache_data(max_entries=128)
+def render_svg(mgf_path: str, mtime_ns: int, scan_number: str, kwargs: dict, max_peaks: int | None = None) -> str:
+    spectrum = build_spectrum(load_scan(mgf_path, mtime_ns, scan_number), f"scan:{scan_number}", max_peaks)
+    return draw_spectrum(spectrum, kwargs)
+
 
 # Streamlit app title
 st.title("MGF Spectra Viewer")
@@ -15,23 +34,20 @@ with st.sidebar:
 
 if mgf_path and scan_number:
 
-    mgf_string = open(mgf_path, "r").read()
+    if not os.path.isfile(mgf_path):
+        st.error(f"File {mgf_path} not found.")
+        st.stop()
+    mtime_ns = os.stat(mgf_path).st_mtime_ns
 
-    scan_content = access_scan(mgf_path, scan_number)
+    scan_content = load_scan(mgf_path, mtime_ns, scan_number)
+    if scan_content is None:
+        st.error(f"Scan {scan_number} not found in the MGF file.")
+        st.stop()
 
-    precursor_mz = float(scan_content["precmz"])
-    if scan_content["charge"] is not None:
-        precursor_charge = int(scan_content["charge"])
-    else:
-        precursor_charge = 1
-    peaks = scan_content["peaks"]
     usi = f"scan:{scan_number}"
-    print(peaks)
-
-    spectrum = parse_tsv_to_spectrum(peaks, precursor_mz, precursor_charge, usi, "\t")
 
     # Calculate dynamic kwargs
-    _mz_min, _mz_max, _max_intensity = calculate_dynamic_kwargs(peaks, peaks_sep="\t")
+    _mz_min, _mz_max, _max_intensity = calculate_dynamic_kwargs(scan_content["mz"], scan_content["intensity"])
 
     with st.sidebar:
         st.write("Drawing Controls")
@@ -41,6 +57,8 @@ if mgf_path and scan_number:
         max_intensity = st.number_input("Max intensity (%)", value=_max_intensity, step=1.0, format="%.0f")
         annotate_precision = st.number_input("Annotate precision", value=4, min_value=0, max_value=10, step=1)
         annotation_rotation = st.number_input("Annotation rotation", value=90, min_value=0, max_value=360, step=1)
+        max_peaks = st.number_input("Max peaks (0 = all)", value=0, min_value=0, step=1,
+                                    help="Keep the most intense peak of each nominal m/z, then the N most intense")
 
     kwargs = {
         "width": 10,
@@ -54,7 +72,8 @@ if mgf_path and scan_number:
         "annotate_precision": annotate_precision,
     }
 
-    svg_content = draw_spectrum(spectrum, kwargs)
+    # Rendered figures are memoized by scan and drawing settings
+    svg_content = render_svg(mgf_path, mtime_ns, scan_number, kwargs, int(max_peaks) or None)
 
     # Display the SVG in Streamlit
     st.image(svg_content, use_container_width=True)
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+# Left-hand side of a calibration equation, and one term of its polynomial, e.g. "-1.2177x2", "+ 13.342x", "-0.1219",
+# "x^2". Spaces are allowed around the sign, the '=' and a '*', but not inside a number or a power of x
+EQUATION_LHS = re.compile(r'\s*y\s*=', re.IGNORECASE)
+TERM_PATTERN = re.compile(
+    r'\s*([+-]?)\s*((?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)?(?:\s*\*\s*)?(x(?:\s*\^\s*2|2|²)?)?\s*')
+# Version of the parser, saved with the cached models so a stricter parser does not reuse models parsed before it
+PARSER_VERSION = 2
+
+# Folder of the parsed models saved between runs, one JSON file per equations TSV content
+DEFAULT_CACHE_DIR = os.environ.get('CALIBRATION_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'calibration_models'))
+
+# Parsed models of each equations TSV, keyed by the SHA-256 of its content
+_MODEL_CACHE = {}
+
+
+class CalibrationModel(NamedTuple):
+    """Calibration curve y = ax^2 + bx + c, where y is the area ratio and x the concentration."""
+    compound: str
+    kind: str  # 'quadratic' or 'linear'
+    a: float
+    b: float
+    c: float
+    # e.g. '1/x' or '1/x^2'. Only informative: weights only matter when fitting, and the coefficients of a weighted fit
+    # are solved like any other
+    weighting: str = ''
+
+
+def parse_equation(equation: str) -> tuple:
+    """
+    Parse a calibration equation into its coefficients.
+    Accepts linear and quadratic equations with or without constant, with spaces around the signs, and with the square
+    written as 'x2', 'x^2' or 'x²' (e.g. 'y = -1.2177x2 + 13.342x + 0.8066', 'y=2x^2-3x', 'y = 0.5x').
+    The terms must cover the whole right-hand side, every term after the first needs its sign, and each power of x
+    can appear only once.
+    :param equation: equation string
+    :return: tuple of (a, b, c)
+    :raises ValueError: if the equation is not 'y = ' followed by such a polynomial
+    """
+    lhs = EQUATION_LHS.match(equation)
+    if not lhs:
+        raise ValueError(f"Invalid calibration equation '{equation}': expected 'y = ...'")
+
+    coefficients = {}
+    position = lhs.end()
+    while position < len(equation):
+        match = TERM_PATTERN.match(equation, position)
+        sign, number, variable = match.groups()
+        if not (number or variable) or (coefficients and not sign):
+            raise ValueError(f"Invalid calibration equation '{equation}': unexpected '{equation[position:].strip()}'")
+        power = '' if variable is None else ('x' if variable == 'x' else 'x2')
+        if power in coefficients:
+            raise ValueError(f"Invalid calibration equation '{equation}': more than one {power or 'constant'} term")
+        value = float(number) if number else 1.0
+        coefficients[power] = -value if sign == '-' else value
+        position = match.end()
+
+    if not coefficients:
+        raise ValueError(f"Invalid calibration equation '{equation}': no terms after 'y ='")
+    return coefficients.get('x2', 0.0), coefficients.get('x', 0.0), coefficients.get('', 0.0)
+
+
+def build_model(compound: str, equation: str, weighting: str = '') -> CalibrationModel:
+    a, b, c = parse_equation(equation)
+    if b == 0 and a == 0:
+        raise ValueError(f"Calibration equation of {compound} does not depend on x: '{equation}'")
+    kind = 'linear' if a == 0 else 'quadratic'
+    return CalibrationModel(compound, kind, a, b, c, weighting)
+
+
+def _file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_models(equations_tsv: str, use_disk_cache=True, cache_dir: str = None) -> dict:
+    """
+    Load the calibration models of an equations TSV (columns Compound, Equation and optionally Weighting).
+    The parsed models are cached in memory and in a '<sha256>.json' file of the cache folder, both keyed by the hash of
+    the TSV content, so the equations are parsed again only when the file changes. Nothing is written next to the TSV.
+    :param equations_tsv: TSV with each standard name and respective calibration equation
+    :param use_disk_cache: read and write the JSON file of the cache folder
+    :param cache_dir: cache folder (default: CALIBRATION_CACHE_DIR environment variable or
+    ~/.cache/calibration_models)
+    :return: dict mapping each compound to its CalibrationModel
+    """
+    file_hash = _file_hash(equations_tsv)
+    if file_hash in _MODEL_CACHE:
+        return _MODEL_CACHE[file_hash]
+
+    sidecar = os.path.join(cache_dir or DEFAULT_CACHE_DIR, f'{file_hash}.json')
+    models = None
+    if use_disk_cache and os.path.exists(sidecar):
+        try:
+            with open(sidecar, 'r') as f:
+                cached = json.load(f)
+            if cached.get('sha256') == file_hash and cached.get('parser') == PARSER_VERSION:
+                models = {record[0]: CalibrationModel(*record) for record in cached['models']}
+        except (OSError, ValueError, TypeError):
+            models = None
+
+    if models is None:
+        equations_df = pd.read_csv(equations_tsv, sep='\t')
+        if 'Weighting' not in equations_df.columns:
+            equations_df['Weighting'] = ''
+        models = {
+            compound: build_model(compound, equation, '' if pd.isna(weighting) else str(weighting))
+            for compound, equation, weighting in equations_df[['Compound', 'Equation', 'Weighting']].itertuples(index=False)
+        }
+        if use_disk_cache:
+            try:
+                os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+                with open(sidecar, 'w') as f:
+                    json.dump({'sha256': file_hash, 'parser': PARSER_VERSION,
+                               'models': [list(model) for model in models.values()]}, f)
+            except OSError as e:
+                print(f"Could not save the calibration models to {sidecar}: {e}")
+
+    _MODEL_CACHE[file_hash] = models
+    return models
+
+
+def solve_quadratic_array(a, b, c, y, return_both=True):
+    """
+    Vectorized version of solve_quadratic: solve ax^2 + bx + c = y for a whole array of y values.
+    :param a: quadratic coefficient
+    :param b: linear coefficient
+    :param c: constant
+    :param y: array with the measured values (area ratios)
+    :param return_both: If True, return both roots. If False, return only the positive one (or the greater if both are
+    negative)
+    :return: tuple of (x1, x2) arrays, or a single array if return_both is False. NaN where there is no real solution
+    """
+    y = np.asarray(y, dtype=np.float64)
+    discriminant = b ** 2 - 4 * a * (c - y)
+    real = discriminant >= 0
+    sqrt_discriminant = np.sqrt(np.where(real, discriminant, np.nan))
+    x1 = (-b + sqrt_discriminant) / (2 * a)
+    x2 = (-b - sqrt_discriminant) / (2 * a)
+
+    # A ratio of 0 means the compound was not detected
+    zero = y == 0
+    x1[zero] = 0
+    x2[zero] = 0
+
+    if return_both:
+        return x1, x2
+    return np.where(x1 >= 0, x1, np.where(x2 >= 0, x2, np.fmax(x1, x2)))
+
+
+def solve(model: CalibrationModel, y, return_both=True):
+    """
+    Calculate the concentrations for an array of area ratios with a calibration model.
+    Linear models have a single solution, returned as x1 (x2 is NaN).
+    :param model: CalibrationModel of the compound
+    :param y: array with the measured area ratios
+    :param return_both: see solve_quadratic_array
+    :return: tuple of (x1, x2) arrays, or a single array if return_both is False
+    """
+    if model.kind == 'quadratic':
+        return solve_quadratic_array(model.a, model.b, model.c, y, return_both=return_both)
+
+    y = np.asarray(y, dtype=np.float64)
+    x = np.where(y == 0, 0.0, (y - model.c) / model.b)
+    if return_both:
+        return x, np.full_like(x, np.nan)
+    return x
@@ -1,6 +1,9 @@
 import math
+import numpy as np
 import pandas as pd
 
+from calibration import load_models, solve
+
 
 def solve_quadratic(a, b, c, y, return_both=True):
     # Rearrange the equation to ax^2 + bx + (c - y) = 0
@@ -32,43 +35,95 @@ def solve_quadratic(a, b, c, y, return_both=True):
         return None
 
 
+def solve_ratios(ratios_df: pd.DataFrame, models: dict, both_roots=True) -> pd.DataFrame:
+    """
+    Calculate the concentrations of all compounds for a DataFrame of area ratios.
+    :param ratios_df: DataFrame with the filename column and one column of area ratios per compound
+    :param models: dict mapping each compound to its CalibrationModel (see calibration.load_models)
+    :param both_roots: If you want to return both roots. If False, returns only the positive one (or if both negative, the greater)
+    :return: pd.DataFrame with the filename column and the concentration columns of each compound
+    """
+    # Each compound is solved for all samples at once, and the output frame is built in a single step at the end
+    columns = {'filename': ratios_df['filename'].to_numpy()}
+    for compound, model in models.items():
+        y = ratios_df[compound].to_numpy(dtype=np.float64)
+        result = solve(model, y, return_both=both_roots)
+        if both_roots:
+            columns[compound + '_x1'], columns[compound + '_x2'] = result
+        else:
+            columns[compound + '_x'] = result
+
+    return pd.DataFrame(columns, index=ratios_df.index)
+
+
 def calculate_conc(ratios_tsv: str, equations_tsv: str, output: str, both_roots=True) -> pd.DataFrame:
     """
     Calculate the concentration, given the quadratic equation, and some other data.
     :param ratios_tsv: TSV with the peak area ratios for the samples
-    :param equations_tsv: TSV with each standard name and respective quadratic equation
+    :param equations_tsv: TSV with each standard name and respective calibration equation (linear or quadratic)
     :param output: file path to save the output TSV
     :param both_roots: If you want to return both roots. If False, returns only the positive one (or if both negative, the greater)
     :return: pd.Dataframe
     """
-    global index
-    results_df = pd.DataFrame()
     ratios_df = pd.read_csv(ratios_tsv, sep='\t')
-    equations_df = pd.read_csv(equations_tsv, sep='\t')
-    for i, compound, equation in equations_df.reset_index().values:
-        a, b, c = equation.split()[2][:-2], equation.split()[4][:-1], equation.split()[6]
-        for index in range(len(ratios_df)):
-            y = ratios_df[compound][index]
-            result = solve_quadratic(float(a), float(b), float(c), float(y), return_both=both_roots)
-            if result:
-                x1, x2 = result
-            else:
-                x1, x2 = ('None', 'None')
-            results_df.at[index, 'filename'] = ratios_df.iloc[index]['filename']
-            results_df.at[index, compound + '_x1'] = str(x1)
-            results_df.at[index, compound + '_x2'] = str(x2)
+    models = load_models(equations_tsv)
+
+    results_df = solve_ratios(ratios_df, models, both_roots=both_roots)
     results_df.to_csv(output, sep='\t', index=False)
     return results_df
 
 
+def calculate_conc_chunked(ratios_tsv: str, equations_tsv: str, output: str, both_roots=True, chunksize=100_000) -> int:
+    """
+    Streaming version of calculate_conc for ratio tables too large to fit in memory.
+    The ratios TSV is read in chunks of `chunksize` samples and the results of each chunk are appended to the output
+    right away, so the memory used does not depend on the number of samples.
+    :param ratios_tsv: TSV with the peak area ratios for the samples
+    :param equations_tsv: TSV with each standard name and respective calibration equation (linear or quadratic)
+    :param output: file path to save the output. Saved as Parquet if it ends with '.parquet' (requires pyarrow),
+    otherwise as TSV
+    :param both_roots: If you want to return both roots. If False, returns only the positive one (or if both negative, the greater)
+    :param chunksize: number of samples processed at a time
+    :return: number of samples written
+    """
+    models = load_models(equations_tsv)
+    parquet = output.endswith('.parquet')
+    writer = None
+    n_samples = 0
+
+    try:
+        for i, ratios_chunk in enumerate(pd.read_csv(ratios_tsv, sep='\t', chunksize=chunksize)):
+            results_chunk = solve_ratios(ratios_chunk, models, both_roots=both_roots)
+            if parquet:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(results_chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+            else:
+                results_chunk.to_csv(output, sep='\t', index=False, mode='w' if i == 0 else 'a', header=i == 0)
+            n_samples += len(results_chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return n_samples
+
+
 def main():
     # Defining parameters
     equations_tsv = './input/equations_template.tsv'
     ratios_tsv = './input/ratio_template.tsv'
     output = 'quantification_results.tsv'
+    chunksize = None  # set a number of samples (e.g. 100_000) to process very large ratio tables in chunks
 
     # Calling function
-    calculate_conc(ratios_tsv, equations_tsv, output, both_roots=True)
+    if chunksize:
+        calculate_conc_chunked(ratios_tsv, equations_tsv, output, both_roots=True, chunksize=chunksize)
+    else:
+        calculate_conc(ratios_tsv, equations_tsv, output, both_roots=True)
 
 
 if __name__ == '__main__':
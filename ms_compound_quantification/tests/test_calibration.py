@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+import calibration
+from calibration import build_model, load_models, parse_equation
+
+
+@pytest.mark.parametrize('equation, coefficients', [
+    ('y = -1.2177x2 + 13.342x + 0.8066', (-1.2177, 13.342, 0.8066)),
+    ('y=2x^2-3x', (2.0, -3.0, 0.0)),
+    ('y = 0.5x', (0.0, 0.5, 0.0)),
+    ('Y = x² - 0.1219', (1.0, 0.0, -0.1219)),
+    ('y = 0.01 + 2.5 * x', (0.0, 2.5, 0.01)),
+    ('y = 1e-3x ^ 2 + x', (0.001, 1.0, 0.0)),
+])
+def test_parse_equation(equation, coefficients):
+    assert parse_equation(equation) == pytest.approx(coefficients)
+
+
+@pytest.mark.parametrize('equation', [
+    '2x + 1',  # no 'y ='
+    'z = 2x + 1',
+    'y =',
+    'y = 2x x',  # 'x' without sign: used to be read as 3x
+    'y = 2x + 3x',  # duplicate power
+    'y = 1 + 2x2 - 3',  # duplicate constant
+    'y = 2x 2',
+    'y = 2x + 1 extra',
+    'y = 2x +',
+    'y = 2y + 1',
+])
+def test_malformed_equations_are_rejected(equation):
+    with pytest.raises(ValueError):
+        parse_equation(equation)
+
+
+def test_equation_without_x_is_rejected():
+    with pytest.raises(ValueError):
+        build_model('compound', 'y = 0.5')
+
+
+def test_parsed_models_are_cached_outside_the_input_folder(tmp_path, monkeypatch):
+    inputs, cache_dir = tmp_path / 'input', tmp_path / 'cache'
+    inputs.mkdir()
+    equations_tsv = inputs / 'equations.tsv'
+    equations_tsv.write_text('Compound\tEquation\tWeighting\nA\ty = 2x2 + 3x + 1\t1/x\nB\ty = 0.5x\t\n')
+
+    models = load_models(str(equations_tsv), cache_dir=str(cache_dir))
+    assert os.listdir(inputs) == ['equations.tsv']
+    assert len(os.listdir(cache_dir)) == 1
+    assert models['A'] == ('A', 'quadratic', 2.0, 3.0, 1.0, '1/x')
+
+    # A new process reads the cached models instead of parsing the equations
+    monkeypatch.setattr(calibration, '_MODEL_CACHE', {})
+    monkeypatch.setattr(calibration, 'build_model', None)
+    assert load_models(str(equations_tsv), cache_dir=str(cache_dir)) == models
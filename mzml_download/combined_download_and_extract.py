@@ -1,118 +1,314 @@
+import argparse
+import queue
+import shutil
+import threading
 import warnings
-import requests
 import os
 import pandas as pd
 import numpy as np
-import pymzml
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 
+from massive_downloader import iter_downloads, massive_payload
+from ms1_cache import cache_path
+from mzml_readers import DEFAULT_READER, READERS
+from mzml_storage import remove_stored, stored_path
+from xic_engine import file_jobs, map_files, summarize_file
+from xic_checkpoint import XicCheckpoint, job_hash
+from xic_peaks import PEAK_COLUMNS
+
 # Suppress warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 # Function to download mzML files
-def download_mzml(df: pd.DataFrame, save_to: str):
+def download_mzml(df: pd.DataFrame, save_to: str, max_workers=4, compress=False):
     if not os.path.exists(save_to):
         os.makedirs(save_to)
     error_log = os.path.join(save_to, 'error_log.txt')
-    url = "https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile"
-    downloaded_files = set(os.listdir(save_to))  # Keep track of already downloaded files
-
-    # Progress bar to track downloads
-    with tqdm(total=len(df), desc="Downloading mzML files", unit="file") as pbar:
-        for i, row in df.iterrows():
-            usi = row['USI']
-            file_name = row['Filename']  # The name of the mzML file to save
-
-            # Skip the file if it's already downloaded
-            if file_name in downloaded_files:
-                pbar.update(1)  # Update progress bar even if the file is skipped
-                print(f'{file_name} already downloaded. Skipping file.')
-                continue
 
-            # Create the download request
-            mzml_file = '/'.join(usi.split(':')[1:3])  # Format the file path for the API
-            payload = {"forceDownload": "true", "file": f"f.{mzml_file}"}
-
-            # Perform the download
-            response = requests.get(url, params=payload)
-            if response.status_code == 200:
-                file_path = os.path.join(save_to, file_name)
-                with open(file_path, 'wb') as f:
-                    f.write(response.content)
-                    print(f"File saved at {file_path}")
-            else:
-                with open(error_log, 'a') as log_file:
-                    log_file.write(f'Error downloading {file_name}\n')
-                print(f"Error downloading {file_name}.")
+    jobs = {}
+    for usi, file_name in df[['USI', 'Filename']].drop_duplicates('Filename').itertuples(index=False):
+        # Skip the file if it's already downloaded (plain or compressed)
+        if os.path.exists(stored_path(os.path.join(save_to, file_name))):
+            print(f'{file_name} already downloaded. Skipping file.')
+            continue
+        jobs[file_name] = massive_payload(usi)
+
+    # Files are streamed to disk in parallel, the progress bar tracks the downloaded bytes
+    for file_name, file_path, error in iter_downloads(jobs, save_to, max_workers=max_workers, compress=compress):
+        if error is None:
+            print(f"File saved at {file_path}")
+        else:
+            with open(error_log, 'a') as log_file:
+                log_file.write(f'Error downloading {file_name}\n')
+            print(f"Error downloading {file_name}: {error}")
 
-            pbar.update(1)  # Update progress bar for each file downloaded
+
+def open_checkpoint(df: pd.DataFrame, mzml_dir: str, result_filename: str, file_groups, jobs: dict, params: dict):
+    """
+    Open the checkpoint of a run and load the results of the files that were already processed with the same
+    parameters (see xic_checkpoint.py).
+    :param df: input DataFrame with the PEAK_COLUMNS
+    :param mzml_dir: folder where the mzML files are saved
+    :param result_filename: name of the results TSV saved in mzml_dir/area_results
+    :param file_groups: row labels of each mzML file
+    :param jobs: summarize_file arguments of each mzML file path (see xic_engine.file_jobs)
+    :param params: extraction settings
+    :return: tuple of (XicCheckpoint, dict mapping each mzML file to its parameter hash, set of completed files)
+    """
+    checkpoint = XicCheckpoint(os.path.join(mzml_dir, 'area_results'), result_filename)
+    hashes = {mzml_file: job_hash(params, rows, jobs[os.path.join(mzml_dir, mzml_file)])
+              for mzml_file, rows in file_groups.items()}
+    done = {mzml_file for mzml_file in file_groups
+            if checkpoint.is_done(mzml_file, stored_path(os.path.join(mzml_dir, mzml_file)), hashes[mzml_file])}
+    if done:
+        checkpoint.load(df, done)
+        print(f"Resuming: {len(done)} of {len(file_groups)} mzML files were already processed.")
+    return checkpoint, hashes, done
 
 
 # Function to extract ion chromatograms and calculate areas with a progress bar
-def extract_ion_chromatograms(df: pd.DataFrame, mzml_dir: str, result_filename: str, rt_tolerance=0.3):
-    with tqdm(total=len(df), desc="Extracting ion chromatograms", unit="file") as pbar:
-        for i, row in df.iterrows():
-            mzml_file = row['Filename']
-            prec_mz = row['Prec_mz']
-            mzml_file_path = os.path.join(mzml_dir, mzml_file)
+def extract_ion_chromatograms(df: pd.DataFrame, mzml_dir: str, result_filename: str, rt_tolerance=0.3, ppm_tolerance=10,
+                              workers=1, use_cache=True, smooth_window=1, resume=True,
+                              reader=DEFAULT_READER):
+    for column in PEAK_COLUMNS:
+        df[column] = np.nan
+    error_log = os.path.join(mzml_dir, 'error_log.txt')
 
-            if not os.path.exists(mzml_file_path):
-                print(f"File {mzml_file_path} not found. Skipping...")
-                pbar.update(1)
-                continue
+    # Group the rows by mzML file so each file is parsed only once for all of its precursors
+    file_groups = df.groupby('Filename', sort=False).groups
+    jobs = file_jobs(df, mzml_dir, file_groups)
+    checkpoint, hashes, done = None, {}, set()
+    if resume:
+        params = {'ppm_tolerance': ppm_tolerance, 'rt_tolerance': rt_tolerance, 'smooth_window': smooth_window}
+        checkpoint, hashes, done = open_checkpoint(df, mzml_dir, result_filename, file_groups, jobs, params)
+
+    job_files = {}
+    for mzml_file in file_groups:
+        mzml_file_path = os.path.join(mzml_dir, mzml_file)
+        if mzml_file in done:
+            del jobs[mzml_file_path]
+            continue
+        if not os.path.exists(stored_path(mzml_file_path)):
+            print(f"File {mzml_file_path} not found. Skipping...")
+            del jobs[mzml_file_path]
+            continue
+        job_files[mzml_file_path] = mzml_file
 
-            run = pymzml.run.Reader(mzml_file_path)
-            target_mz = prec_mz
-            ppm_tolerance = 10
-            mz_tolerance = target_mz * (ppm_tolerance / 1e6)
-            mz_min = target_mz - mz_tolerance
-            mz_max = target_mz + mz_tolerance
-            xic_data = []
-
-            for spectrum in run:
-                if spectrum.ms_level == 1:
-                    rt = spectrum.scan_time_in_minutes()
-                    intensities = spectrum.i[
-                        (spectrum.mz >= mz_min) & (spectrum.mz <= mz_max)
-                        ]
-                    total_intensity = sum(intensities)
-                    xic_data.append((rt, total_intensity))
-
-            if xic_data:
-                rt_values, intensity_values = zip(*xic_data)
-                auc = np.trapezoid(intensity_values, rt_values)
-                peak = max(xic_data, key=lambda x: x[1])
-                peak_retention_time = peak[0]
-                peak_intensity = peak[1]
-
-                # rt_tolerance in min
-                rt_min = peak_retention_time - rt_tolerance
-                rt_max = peak_retention_time + rt_tolerance
-                peak_range = [(rt, intensity) for rt, intensity in xic_data if rt_min <= rt <= rt_max]
-                x_values, y_values = zip(*peak_range)
-                peak_area = np.trapezoid(y_values, x_values)
-
-                df.at[i, 'area_under_curve'] = auc
-                df.at[i, 'peak_area'] = peak_area
-                df.at[i, 'peak_rt'] = peak_retention_time
-                df.at[i, 'peak_intensity'] = peak_intensity
+    with tqdm(total=len(file_groups), initial=len(file_groups) - len(jobs), desc="Extracting ion chromatograms",
+              unit="file") as pbar:
+        for mzml_file_path, summary, error in map_files(jobs, workers=workers, ppm_tolerance=ppm_tolerance,
+                                                        rt_tolerance=rt_tolerance, use_cache=use_cache,
+                                                        smooth_window=smooth_window, reader=reader):
+            if error is not None:
+                with open(error_log, 'a') as log_file:
+                    log_file.write(f'Error extracting {mzml_file_path}: {error}\n')
+                print(f"Error extracting {mzml_file_path}: {error}")
             else:
-                df.at[i, 'area_under_curve'] = np.nan
-                df.at[i, 'peak_area'] = np.nan
-                df.at[i, 'peak_rt'] = np.nan
-                df.at[i, 'peak_intensity'] = np.nan
+                # Results come back in completion order, so they are written by row label
+                mzml_file = job_files[mzml_file_path]
+                df.loc[file_groups[mzml_file], PEAK_COLUMNS] = np.column_stack(
+                    [summary[column] for column in PEAK_COLUMNS])
+                if checkpoint is not None:
+                    checkpoint.record(mzml_file, stored_path(mzml_file_path), hashes[mzml_file], file_groups[mzml_file],
+                                      summary)
 
             pbar.update(1)  # Update progress bar for each file processed
 
+    save_results(df, mzml_dir, result_filename)
+
+
+def save_results(df: pd.DataFrame, mzml_dir: str, result_filename: str):
     result_dir = os.path.join(mzml_dir, 'area_results')
     if not os.path.exists(result_dir):
         os.makedirs(result_dir)
     df.to_csv(os.path.join(result_dir, result_filename), sep='\t', index=False)
 
 
+class _DiskBudget:
+    """Track the size of the downloaded mzML files that were not processed yet, and hold back downloads above a limit."""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def wait(self):
+        if self.max_bytes is None:
+            return
+        with self.condition:
+            self.condition.wait_for(lambda: self.used < self.max_bytes)
+
+    def add(self, n):
+        with self.condition:
+            self.used += n
+
+    def release(self, n):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+
+def download_and_extract(df: pd.DataFrame, mzml_dir: str, result_filename: str, rt_tolerance=0.3, ppm_tolerance=10,
+                         workers=1, downloads=4, use_cache=True, queue_size=8, max_disk_bytes=None,
+                         delete_processed=False, smooth_window=1, resume=True,
+                         reader=DEFAULT_READER, compress=False):
+    """
+    Download the mzML files of a TSV and extract their ion chromatograms at the same time.
+    Each file is queued for XIC extraction as soon as its download finishes, so downloads and parsing overlap.
+    :param df: DataFrame with the USI, Filename and Prec_mz columns, and optionally RT_min and RT_max (expected
+    retention time window of each precursor, in minutes). Only the spectra inside the windows are decoded
+    :param mzml_dir: folder where the mzML files are saved
+    :param result_filename: name of the results TSV saved in mzml_dir/area_results
+    :param rt_tolerance: maximum distance (in minutes) between the apex and each peak boundary
+    :param ppm_tolerance: tolerance in ppm around each precursor m/z
+    :param workers: number of processes used to extract ion chromatograms
+    :param downloads: number of simultaneous downloads
+    :param use_cache: read the scans through the MS1 cache kept next to the mzML files
+    :param queue_size: maximum number of downloaded files waiting for a free XIC worker
+    :param max_disk_bytes: new downloads wait while the downloaded files that are not processed yet take more than
+    this many bytes. None means no limit
+    :param delete_processed: delete each mzML file (and its MS1 cache) once its ion chromatograms were extracted
+    :param smooth_window: number of scans of the moving average applied before peak detection
+    :param resume: save the results of each file as soon as it is processed, and skip the files already processed
+    with the same parameters by a previous (e.g. interrupted) run
+    :param reader: mzML reader: 'auto', 'lxml' or 'pymzml' (see mzml_readers.py)
+    :param compress: save the downloaded mzML files gzip-compressed (file.mzML.gz, see mzml_storage.py). The readers
+    open either form
+    :return: the DataFrame with the results
+    """
+    for column in PEAK_COLUMNS:
+        df[column] = np.nan
+    os.makedirs(mzml_dir, exist_ok=True)
+    error_log = os.path.join(mzml_dir, 'error_log.txt')
+
+    file_groups = df.groupby('Filename', sort=False).groups
+    xic_jobs = file_jobs(df, mzml_dir, file_groups)
+    checkpoint, hashes, done = None, {}, set()
+    if resume:
+        params = {'ppm_tolerance': ppm_tolerance, 'rt_tolerance': rt_tolerance, 'smooth_window': smooth_window}
+        checkpoint, hashes, done = open_checkpoint(df, mzml_dir, result_filename, file_groups, xic_jobs, params)
+    # Completed files are neither downloaded nor processed again
+    pending = [mzml_file for mzml_file in file_groups if mzml_file not in done]
+    usis = df.drop_duplicates('Filename').set_index('Filename')['USI']
+    downloaded_files = {mzml_file for mzml_file in pending
+                        if os.path.exists(stored_path(os.path.join(mzml_dir, mzml_file)))}
+    budget = _DiskBudget(max_disk_bytes)
+    ready = queue.Queue(maxsize=queue_size)
+    # Deleting the files afterwards makes the MS1 cache useless
+    use_cache = use_cache and not delete_processed
+
+    def produce():
+        try:
+            for mzml_file in pending:
+                if mzml_file in downloaded_files:
+                    budget.add(os.path.getsize(stored_path(os.path.join(mzml_dir, mzml_file))))
+                    ready.put((mzml_file, None))
+            jobs = {mzml_file: massive_payload(usis[mzml_file]) for mzml_file in pending
+                    if mzml_file not in downloaded_files}
+            for mzml_file, file_path, error in iter_downloads(jobs, mzml_dir, max_workers=downloads,
+                                                              before_download=budget.wait, compress=compress):
+                if error is None:
+                    budget.add(os.path.getsize(file_path))
+                ready.put((mzml_file, error))
+        finally:
+            ready.put(None)
+
+    results, errors = {}, {}
+    slots = threading.Semaphore(max(1, workers))
+    producer = threading.Thread(target=produce, daemon=True)
+
+    with tqdm(total=len(file_groups), initial=len(done), desc="Extracting ion chromatograms", unit="file") as pbar, \
+            ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+
+        def finished(future, mzml_file, stored_file_path, size):
+            try:
+                results[mzml_file] = future.result()
+                if checkpoint is not None:
+                    checkpoint.record(mzml_file, stored_file_path, hashes[mzml_file], file_groups[mzml_file],
+                                      results[mzml_file])
+            except Exception as e:
+                errors[mzml_file] = e
+            try:
+                if delete_processed:
+                    remove_stored(stored_file_path)
+                    shutil.rmtree(cache_path(stored_file_path), ignore_errors=True)
+            except OSError as e:
+                with open(error_log, 'a') as log_file:
+                    log_file.write(f'Error deleting {stored_file_path}: {e}\n')
+                print(f"Error deleting {stored_file_path}: {e}")
+            finally:
+                # Always free the worker slot and the disk budget, or the main loop waits forever
+                budget.release(size)
+                slots.release()
+                pbar.update(1)
+
+        producer.start()
+        while True:
+            # Only take a file from the queue when a worker is free, so the queue applies back-pressure to the downloads
+            slots.acquire()
+            item = ready.get()
+            if item is None:
+                break
+            mzml_file, error = item
+            if error is not None:
+                with open(error_log, 'a') as log_file:
+                    log_file.write(f'Error downloading {mzml_file}\n')
+                print(f"Error downloading {mzml_file}: {error}")
+                slots.release()
+                pbar.update(1)
+                continue
+
+            mzml_file_path = os.path.join(mzml_dir, mzml_file)
+            future = executor.submit(summarize_file, mzml_file_path, **xic_jobs[mzml_file_path], ppm_tolerance=ppm_tolerance,
+                                     rt_tolerance=rt_tolerance, use_cache=use_cache, smooth_window=smooth_window,
+                                     reader=reader)
+            stored_file_path = stored_path(mzml_file_path)
+            future.add_done_callback(
+                partial(finished, mzml_file=mzml_file, stored_file_path=stored_file_path,
+                        size=os.path.getsize(stored_file_path)))
+    producer.join()
+
+    for mzml_file, error in errors.items():
+        with open(error_log, 'a') as log_file:
+            log_file.write(f'Error extracting {mzml_file}: {error}\n')
+        print(f"Error extracting {mzml_file}: {error}")
+    for mzml_file, summary in results.items():
+        df.loc[file_groups[mzml_file], PEAK_COLUMNS] = np.column_stack([summary[column] for column in PEAK_COLUMNS])
+
+    save_results(df, mzml_dir, result_filename)
+    return df
+
+
 # Main flow
 def main():
+    parser = argparse.ArgumentParser(description="Download mzML files from MassIVE and extract ion chromatograms")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to extract ion chromatograms (default: 1)')
+    parser.add_argument('-d', '--downloads', type=int, default=4,
+                        help='Number of mzML files downloaded at the same time (default: 4)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the MS1 cache next to the mzML files')
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Maximum number of downloaded files waiting for XIC extraction (default: 8)')
+    parser.add_argument('--max-disk-gb', type=float, default=None,
+                        help='Pause downloads while the unprocessed mzML files take more than this many GB')
+    parser.add_argument('--delete-processed', action='store_true',
+                        help='Delete each mzML file after its ion chromatograms were extracted')
+    parser.add_argument('--smooth', type=int, default=1,
+                        help='Number of scans of the moving average applied before peak detection (default: 1, none)')
+    parser.add_argument('--reader', choices=[DEFAULT_READER, *READERS], default=DEFAULT_READER,
+                        help='mzML reader: lxml (fast, MS1 only), pymzml, or auto to use lxml when it is installed '
+                             '(default: auto)')
+    parser.add_argument('--compress', action='store_true',
+                        help='Save the downloaded mzML files gzip-compressed (read back transparently)')
+    parser.add_argument('--no-resume', action='store_true',
+                        help='Process every mzML file again instead of resuming from the results of a previous run')
+    args = parser.parse_args()
+    max_disk_bytes = int(args.max_disk_gb * 1024 ** 3) if args.max_disk_gb else None
+
     directory = './_files/input_tsv'
     tsv_list = [file for file in os.listdir(directory) if file.endswith('.tsv')]
     mzml_save_dir = './_files/mzml_files'
@@ -121,14 +317,14 @@ def main():
     for file_name in tsv_list:
         df = pd.read_csv(os.path.join(directory, file_name), sep='\t')
 
-        # Step 1: Download mzML files to a single folder
-        print(f"Downloading mzML files for {file_name}...")
-        download_mzml(df, mzml_save_dir)
-
-        # Step 2: Extract ion chromatograms and calculate areas
-        print(f"Extracting ion chromatograms and calculating areas for {file_name}...")
+        # Download the mzML files and extract the ion chromatograms of each file as soon as it is on disk
+        print(f"Downloading mzML files and extracting ion chromatograms for {file_name}...")
         results_file = f'{file_name[:-4]}_xic_results.tsv'
-        extract_ion_chromatograms(df, mzml_save_dir, results_file, rt_tolerance=rt_tolerance)
+        download_and_extract(df, mzml_save_dir, results_file, rt_tolerance=rt_tolerance, workers=args.workers,
+                             downloads=args.downloads, use_cache=not args.no_cache, queue_size=args.queue_size,
+                             max_disk_bytes=max_disk_bytes, delete_processed=args.delete_processed,
+                             smooth_window=args.smooth, resume=not args.no_resume, reader=args.reader,
+                             compress=args.compress)
 
 
 if __name__ == '__main__':
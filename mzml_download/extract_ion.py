@@ -1,64 +1,76 @@
-import pymzml
+import argparse
 import os
 import numpy as np
 import pandas as pd
+from tqdm import tqdm
 
-directory = './_files/input_tsv'
-tsv_list = [file for file in os.listdir(directory) if file.endswith('.tsv')]
-for file_name in tsv_list:
-    df = pd.read_csv(os.path.join(directory, file_name), sep='\t')
-    df['area_under_curve'] = ''
-    df['peak_rt'] = ''
-    df['peak_intensity'] = ''
+from mzml_readers import DEFAULT_READER, READERS
+from xic_engine import file_jobs, map_files
+from xic_peaks import PEAK_COLUMNS
 
-    for i, row in df.iterrows():
-        prec_mz = row['Prec_mz']
-        mzml_file = row['Filename']
-        mzml_file_path = os.path.join(directory, file_name[:-4], mzml_file)
-        # Load the mzML file
 
-        run = pymzml.run.Reader(mzml_file_path)
+def extract_areas(df: pd.DataFrame, mzml_dir: str, workers=1, ppm_tolerance=10, use_cache=True, rt_tolerance=0.3,
+                  smooth_window=1, reader=DEFAULT_READER):
+    """
+    Calculate the area under the XIC curve and integrate the XIC peak for each row of the DataFrame.
+    :param df: DataFrame with the Filename and Prec_mz columns, and optionally RT_min and RT_max (expected retention
+    time window of each precursor, in minutes)
+    :param mzml_dir: folder where the mzML files are stored
+    :param workers: number of processes used to extract the ion chromatograms
+    :param ppm_tolerance: tolerance in ppm around each precursor m/z
+    :param use_cache: read the scans through the MS1 cache kept next to the mzML files
+    :param rt_tolerance: maximum distance (in minutes) between the apex and each peak boundary
+    :param smooth_window: number of scans of the moving average applied before peak detection
+    :param reader: mzML reader: 'auto', 'lxml' or 'pymzml' (see mzml_readers.py)
+    :return: the DataFrame with the PEAK_COLUMNS filled in (see xic_peaks.py)
+    """
+    for column in PEAK_COLUMNS:
+        df[column] = np.nan
 
-        # Define the m/z target and tolerance
-        target_mz = prec_mz  # The m/z of the ion you are interested in
-        ppm_tolerance = 10  # Example: 10 ppm tolerance
-        mz_tolerance = target_mz * (ppm_tolerance / 1e6)
-        mz_min = target_mz - mz_tolerance
-        mz_max = target_mz + mz_tolerance
+    # Load each mzML file only once for all of its precursors
+    file_groups = df.groupby('Filename', sort=False).groups
+    jobs = file_jobs(df, mzml_dir, file_groups)
+    job_rows = {os.path.join(mzml_dir, mzml_file): rows for mzml_file, rows in file_groups.items()}
 
-        # Initialize a list to store XIC data (retention time vs intensity)
-        xic_data = []
+    with tqdm(total=len(jobs), desc="Extracting ion chromatograms", unit="file") as pbar:
+        for mzml_file_path, summary, error in map_files(jobs, workers=workers, ppm_tolerance=ppm_tolerance,
+                                                        rt_tolerance=rt_tolerance, use_cache=use_cache,
+                                                        smooth_window=smooth_window, reader=reader):
+            if error is not None:
+                print(f"Error extracting {mzml_file_path}: {error}")
+            else:
+                df.loc[job_rows[mzml_file_path], PEAK_COLUMNS] = np.column_stack(
+                    [summary[column] for column in PEAK_COLUMNS])
+            pbar.update(1)
 
-        # Loop over each spectrum in the mzML file
-        for spectrum in run:
-            if spectrum.ms_level == 1:  # Only extract from MS1 spectra
-                # Get the retention time in minutes (or seconds depending on your data)
-                rt = spectrum.scan_time_in_minutes()
+    return df
 
-                # Extract intensities for the m/z range within the tolerance
-                intensities = spectrum.i[
-                    (spectrum.mz >= mz_min) & (spectrum.mz <= mz_max)
-                    ]
 
-                # Sum the intensities in the m/z window to get total intensity for that scan
-                total_intensity = sum(intensities)
+def main():
+    parser = argparse.ArgumentParser(description="Extract ion chromatograms from downloaded mzML files")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes used to extract ion chromatograms (default: 1)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the MS1 cache next to the mzML files')
+    parser.add_argument('--smooth', type=int, default=1,
+                        help='Number of scans of the moving average applied before peak detection (default: 1, none)')
+    parser.add_argument('--reader', choices=[DEFAULT_READER, *READERS], default=DEFAULT_READER,
+                        help='mzML reader: lxml (fast, MS1 only), pymzml, or auto to use lxml when it is installed '
+                             '(default: auto)')
+    args = parser.parse_args()
 
-                # Append the retention time and intensity to the XIC data
-                xic_data.append((rt, total_intensity))
+    directory = './_files/input_tsv'
+    tsv_list = [file for file in os.listdir(directory) if file.endswith('.tsv')]
+    for file_name in tsv_list:
+        df = pd.read_csv(os.path.join(directory, file_name), sep='\t')
+        # mzML files are downloaded to a folder named after the input TSV
+        extract_areas(df, os.path.join(directory, file_name[:-4]), workers=args.workers, use_cache=not args.no_cache,
+                      smooth_window=args.smooth, reader=args.reader)
 
-        # for rt, intensity in xic_data:
-        #     print(f"RT: {rt:.2f} min, Intensity: {intensity:.2f}")
+        # saving the results
+        os.makedirs(os.path.join(directory, 'area_results'), exist_ok=True)
+        df.to_csv(os.path.join(directory, 'area_results', file_name + '_xic_results.tsv'), sep='\t', index=False)
 
-        # # Unzip XIC data into retention times and intensities
-        rt_values, intensity_values = zip(*xic_data)
-        auc = np.trapezoid(intensity_values, rt_values)
-        peak = max(xic_data, key=lambda x: x[1])
-        peak_retention_time = peak[0]
-        peak_intensity = peak[1]
 
-        df.at[i, 'area_under_curve'] = auc
-        df.at[i, 'peak_rt'] = peak_retention_time
-        df.at[i, 'peak_intensity'] = peak_intensity
-
-    # saving the results
-    df.to_csv(os.path.join(directory,'area_results', file_name+'_xic_results.tsv'), sep='\t', index=False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from mzml_storage import GZIP_SUFFIX, INDEX_SUFFIX, BlockedGzipWriter, remove_stored
+
+MASSIVE_DOWNLOAD_URL = "https://massive.ucsd.edu/ProteoSAFe/DownloadResultFile"
+
+
+def massive_payload(usi: str) -> dict:
+    """
+    Build the query parameters used by MassIVE to download the file referenced by a USI.
+    :param usi: USI of the file ('mzspec:MSV000085123:file.mzML')
+    :return: dict with the query parameters
+    """
+    mzml_file = '/'.join(usi.split(':')[1:3])  # Format the file path for the API
+    return {"forceDownload": "true", "file": f"f.{mzml_file}"}
+
+
+def create_session(max_workers=4) -> requests.Session:
+    """
+    Create a requests session whose connection pool is large enough for max_workers threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class _ByteProgress:
+    """Thread-safe wrapper around one tqdm bar shared by all downloads."""
+
+    def __init__(self, pbar: tqdm):
+        self.pbar = pbar
+        self.lock = threading.Lock()
+
+    def add_total(self, n):
+        with self.lock:
+            self.pbar.total = (self.pbar.total or 0) + n
+            self.pbar.refresh()
+
+    def update(self, n):
+        with self.lock:
+            self.pbar.update(n)
+
+
+def download_file(session: requests.Session, url: str, params: dict, file_path: str, chunk_size=1 << 20,
+                  progress: _ByteProgress = None, timeout=60, compress=False) -> str:
+    """
+    Stream a file to disk. The content is written to file_path + '.part' and renamed to file_path once complete.
+    If a '.part' file from an interrupted download exists, the download resumes from where it stopped using an
+    HTTP Range request (the file is downloaded again if the server does not support ranges).
+    With compress, the content is gzip-compressed while it streams and saved to file_path + '.gz' with its block index
+    (see mzml_storage.py); the plain file never touches the disk.
+    :param session: requests session used for the request
+    :param url: download URL
+    :param params: query parameters of the request
+    :param file_path: final path of the file
+    :param chunk_size: size in bytes of the chunks written to disk
+    :param progress: shared byte progress bar
+    :param timeout: connection/read timeout in seconds
+    :param compress: save the file gzip-compressed
+    :return: path of the saved file
+    """
+    if compress:
+        return _download_compressed(session, url, params, file_path + GZIP_SUFFIX, chunk_size, progress, timeout)
+    part_path = file_path + '.part'
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={resume_from}-'} if resume_from else {}
+
+    with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416:
+            # The partial file does not match the remote file anymore, start over
+            os.remove(part_path)
+            return download_file(session, url, params, file_path, chunk_size, progress, timeout)
+        response.raise_for_status()
+
+        # 206 means the server honoured the Range header, otherwise the whole file is sent again
+        mode = 'ab' if response.status_code == 206 else 'wb'
+        if progress is not None:
+            progress.add_total(int(response.headers.get('content-length', 0)))
+
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+
+    os.replace(part_path, file_path)
+    return file_path
+
+
+def _download_compressed(session, url, params, gz_path, chunk_size, progress, timeout):
+    part_path = gz_path + '.part'
+    # Only complete blocks are kept, so the download resumes from the end of the last one
+    writer = BlockedGzipWriter(part_path, resume=True)
+    headers = {'Range': f'bytes={writer.raw_size}-'} if writer.raw_size else {}
+
+    try:
+        with session.get(url, params=params, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 416:
+                writer.close()
+                remove_stored(part_path)
+                return _download_compressed(session, url, params, gz_path, chunk_size, progress, timeout)
+            response.raise_for_status()
+
+            if response.status_code != 206 and writer.raw_size:
+                # The server ignored the Range header and sends the whole file again
+                writer.close()
+                remove_stored(part_path)
+                writer = BlockedGzipWriter(part_path)
+            if progress is not None:
+                progress.add_total(int(response.headers.get('content-length', 0)))
+
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                writer.write(chunk)
+                if progress is not None:
+                    progress.update(len(chunk))
+    except BaseException:
+        writer.close()
+        if not writer.raw_size and os.path.exists(part_path):
+            # Nothing was downloaded (e.g. 404): leave no empty partial file to resume from
+            remove_stored(part_path)
+        raise
+    writer.close()
+
+    # The index goes first: a .gz file without its index is still readable, only sequentially
+    os.replace(part_path + INDEX_SUFFIX, gz_path + INDEX_SUFFIX)
+    os.replace(part_path, gz_path)
+    return gz_path
+
+
+def iter_downloads(jobs: dict, save_to: str, url: str = MASSIVE_DOWNLOAD_URL, max_workers=4, chunk_size=1 << 20,
+                   session: requests.Session = None, before_download=None, compress=False):
+    """
+    Download several files concurrently with a bounded thread pool sharing one session.
+    :param jobs: dict mapping each file name to the query parameters used to download it
+    :param save_to: folder where the files are saved
+    :param url: download URL
+    :param max_workers: maximum number of simultaneous downloads
+    :param chunk_size: size in bytes of the chunks written to disk
+    :param session: requests session to use. If None, a pooled session is created
+    :param before_download: optional callable run by the download thread before each download starts. It can block to
+    hold back new downloads (e.g. while the disk is full)
+    :param compress: save the files gzip-compressed (file_name + '.gz', see download_file)
+    :return: generator of (file name, file path, exception or None), in order of completion
+    """
+    os.makedirs(save_to, exist_ok=True)
+    session = session or create_session(max_workers)
+
+    with tqdm(total=0, desc="Downloading mzML files", unit="B", unit_scale=True, unit_divisor=1024) as pbar, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        progress = _ByteProgress(pbar)
+
+        def run(file_name, params):
+            if before_download is not None:
+                before_download()
+            return download_file(session, url, params, os.path.join(save_to, file_name), chunk_size, progress,
+                                 compress=compress)
+
+        futures = {executor.submit(run, file_name, params): file_name for file_name, params in jobs.items()}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                yield file_name, future.result(), None
+            except Exception as e:
+                yield file_name, os.path.join(save_to, file_name), e
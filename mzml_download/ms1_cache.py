@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = '.ms1cache'
+
+
+def cache_path(mzml_file_path: str, cache_dir: str = None) -> str:
+    """
+    Get the path of the sidecar cache folder of an mzML file.
+    :param mzml_file_path: path to the mzML file
+    :param cache_dir: folder to keep the caches in. If None, the cache is saved next to the mzML file
+    :return: path of the cache folder
+    """
+    if cache_dir is None:
+        return mzml_file_path + CACHE_SUFFIX
+    return os.path.join(cache_dir, os.path.basename(mzml_file_path) + CACHE_SUFFIX)
+
+
+def _file_signature(mzml_file_path: str) -> dict:
+    stat = os.stat(mzml_file_path)
+    return {'mzml_size': stat.st_size, 'mzml_mtime_ns': stat.st_mtime_ns}
+
+
+def in_rt_intervals(rt, rt_intervals):
+    """
+    Check which retention times fall inside a set of intervals.
+    :param rt: retention times in minutes
+    :param rt_intervals: sorted, non-overlapping (start, end) intervals in minutes
+    :return: boolean array
+    """
+    rt = np.asarray(rt, dtype=np.float64)
+    if not len(rt_intervals):
+        return np.zeros(rt.shape, dtype=bool)
+    starts, ends = np.asarray(rt_intervals, dtype=np.float64).T
+    # Index of the last interval starting at or before each retention time
+    k = np.searchsorted(starts, rt, side='right') - 1
+    return (k >= 0) & (rt <= ends[np.maximum(k, 0)])
+
+
+class Ms1Cache:
+    """
+    Memory-mapped MS1 scans of an mzML file.
+    The peaks of all scans are concatenated in mz and intensity; the peaks of scan k are
+    mz[offsets[k]:offsets[k + 1]] and its retention time (in minutes) is rt[k].
+    """
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.meta = meta
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.rt = index['rt']
+        self.offsets = index['offsets']
+        n_peaks = meta['n_peaks']
+        if n_peaks:
+            self.mz = np.memmap(os.path.join(path, 'mz.f64'), dtype=np.float64, mode='r', shape=(n_peaks,))
+            self.intensity = np.memmap(os.path.join(path, 'intensity.f32'), dtype=np.float32, mode='r',
+                                       shape=(n_peaks,))
+        else:
+            self.mz = np.empty(0, dtype=np.float64)
+            self.intensity = np.empty(0, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.rt)
+
+    def iter_scans(self, rt_intervals=None):
+        """
+        Iterate over the cached scans.
+        :param rt_intervals: sorted, non-overlapping (start, end) retention time intervals in minutes. Only the scans
+        inside them are read. None reads every scan
+        :return: generator of (retention time in minutes, m/z array, intensity array)
+        """
+        if rt_intervals is None:
+            scans = range(len(self.rt))
+        elif len(self.rt) < 2 or np.all(self.rt[1:] >= self.rt[:-1]):
+            # Scans in retention time order: each interval is a contiguous slice
+            scans = (k for start, end in rt_intervals
+                     for k in range(np.searchsorted(self.rt, start, side='left'),
+                                    np.searchsorted(self.rt, end, side='right')))
+        else:
+            scans = np.flatnonzero(in_rt_intervals(self.rt, rt_intervals))
+        for k in scans:
+            start, end = self.offsets[k], self.offsets[k + 1]
+            yield self.rt[k], self.mz[start:end], self.intensity[start:end]
+
+
+def load_cache(mzml_file_path: str, cache_dir: str = None):
+    """
+    Open the MS1 cache of an mzML file if it exists and is up to date.
+    The cache is considered stale when the size or modification time of the mzML file changed.
+    :param mzml_file_path: path to the mzML file
+    :param cache_dir: folder where the caches are kept (see cache_path)
+    :return: Ms1Cache, or None if there is no valid cache
+    """
+    path = cache_path(mzml_file_path, cache_dir)
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    expected = dict(_file_signature(mzml_file_path), version=CACHE_VERSION)
+    if any(meta.get(key) != value for key, value in expected.items()):
+        return None
+    return Ms1Cache(path, meta)
+
+
+class Ms1CacheWriter:
+    """
+    Write the MS1 scans of an mzML file to its sidecar cache while they are being read.
+    The arrays are streamed to a temporary folder that only replaces the cache once close() is called,
+    so an interrupted run never leaves a half-written cache behind.
+    """
+
+    def __init__(self, mzml_file_path: str, cache_dir: str = None):
+        self.mzml_file_path = mzml_file_path
+        self.path = cache_path(mzml_file_path, cache_dir)
+        self.tmp_path = f'{self.path}.tmp-{os.getpid()}'
+        self.signature = _file_signature(mzml_file_path)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self._mz_file = open(os.path.join(self.tmp_path, 'mz.f64'), 'wb')
+        self._intensity_file = open(os.path.join(self.tmp_path, 'intensity.f32'), 'wb')
+        self.rt = []
+        self.offsets = [0]
+
+    def add(self, rt, mz, intensity):
+        np.asarray(mz, dtype=np.float64).tofile(self._mz_file)
+        np.asarray(intensity, dtype=np.float32).tofile(self._intensity_file)
+        self.rt.append(rt)
+        self.offsets.append(self.offsets[-1] + len(mz))
+
+    def close(self):
+        self._mz_file.close()
+        self._intensity_file.close()
+        np.savez(os.path.join(self.tmp_path, 'index.npz'), rt=np.asarray(self.rt, dtype=np.float64),
+                 offsets=np.asarray(self.offsets, dtype=np.int64))
+        meta = dict(self.signature, version=CACHE_VERSION, n_scans=len(self.rt), n_peaks=self.offsets[-1])
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self._mz_file.close()
+        self._intensity_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,417 @@
+import argparse
+import base64
+import io
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+import pymzml
+
+from ms1_cache import in_rt_intervals
+from mzml_storage import has_random_access, open_mzml
+
+try:
+    from lxml import etree
+except ImportError:  # pymzml is used instead
+    etree = None
+
+# PSI-MS controlled vocabulary accessions read by the lxml backend
+MS_LEVEL = 'MS:1000511'
+MS1_SPECTRUM = 'MS:1000579'
+SCAN_START_TIME = 'MS:1000016'
+MZ_ARRAY = 'MS:1000514'
+INTENSITY_ARRAY = 'MS:1000515'
+ZLIB_COMPRESSION = 'MS:1000574'
+NO_COMPRESSION = 'MS:1000576'
+DTYPES = {'MS:1000521': np.float32, 'MS:1000523': np.float64, 'MS:1000519': np.int32, 'MS:1000522': np.int64}
+SECOND_UNITS = {'UO:0000010', 'second'}
+
+PARSED_TAGS = ('{*}spectrum', '{*}referenceableParamGroup', '{*}spectrumList')
+# Patterns of the index of an indexed mzML, and of the scan time of a spectrum read at its offset
+INDEX_LIST_OFFSET = re.compile(rb'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+SPECTRUM_INDEX = re.compile(rb'<index\s+name="spectrum"\s*>(.*?)</index>', re.DOTALL)
+OFFSET = re.compile(rb'<offset[^>]*>\s*(\d+)\s*</offset>')
+SCAN_TIME_PARAM = re.compile(rb'<cvParam[^>]*"MS:1000016"[^>]*>')
+ATTRIBUTE = re.compile(rb'([\w:]+)="([^"]*)"')
+RT_PROBE_SIZE = 1 << 14
+
+DEFAULT_READER = 'auto'
+
+
+class UnsupportedEncoding(Exception):
+    """Raised by the lxml backend for binary arrays it cannot decode (e.g. MS-Numpress compression)."""
+
+
+def _last_end(rt_intervals):
+    return rt_intervals[-1][1] if rt_intervals is not None else np.inf
+
+
+def iter_pymzml(mzml_file_path, rt_intervals=None):
+    """
+    Iterate over the MS1 spectra of an mzML file with pymzml.
+    :param mzml_file_path: path to the mzML file (.mzML or .mzML.gz)
+    :param rt_intervals: sorted, non-overlapping (start, end) retention time intervals in minutes. Only the spectra
+    inside them are decoded. None reads every spectrum
+    :return: generator of (retention time in minutes, m/z array, intensity array)
+    """
+    if rt_intervals is not None and not rt_intervals:
+        return
+    last_end = _last_end(rt_intervals)
+
+    run = pymzml.run.Reader(mzml_file_path)
+    for spectrum in run:
+        if spectrum.ms_level != 1:
+            continue
+        # pymzml decodes the peaks lazily: check the scan time before touching mz/i
+        rt = spectrum.scan_time_in_minutes()
+        if rt_intervals is not None:
+            if rt > last_end:
+                break
+            if not in_rt_intervals([rt], rt_intervals)[0]:
+                continue
+        yield rt, spectrum.mz, spectrum.i
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+def _cv_params(element, groups):
+    """Collect the cvParams of an element, including those of its referenceable param groups, as {accession: param}."""
+    params = {}
+    for child in element:
+        name = _local(child.tag)
+        if name == 'cvParam':
+            params[child.get('accession')] = child
+        elif name == 'referenceableParamGroupRef':
+            params.update(groups.get(child.get('ref'), {}))
+    return params
+
+
+def _ms_level(params):
+    if MS_LEVEL in params:
+        return int(params[MS_LEVEL].get('value'))
+    return 1 if MS1_SPECTRUM in params else None
+
+
+def _scan_time(spectrum, groups):
+    for scan in spectrum.iterfind('{*}scanList/{*}scan'):
+        param = _cv_params(scan, groups).get(SCAN_START_TIME)
+        if param is not None:
+            rt = float(param.get('value'))
+            unit = param.get('unitAccession') or param.get('unitName')
+            return rt / 60 if unit in SECOND_UNITS else rt
+    return np.nan
+
+
+def _decode(binary_data_array, groups, buffer_sizes):
+    """
+    Decode one binaryDataArray.
+    :return: tuple of (array kind: MZ_ARRAY, INTENSITY_ARRAY or None, numpy array)
+    """
+    params = _cv_params(binary_data_array, groups)
+    kind = MZ_ARRAY if MZ_ARRAY in params else INTENSITY_ARRAY if INTENSITY_ARRAY in params else None
+    if kind is None:
+        return None, None
+    dtype = next((dtype for accession, dtype in DTYPES.items() if accession in params), None)
+    if dtype is None:
+        raise UnsupportedEncoding('Binary data array without a supported data type')
+
+    text = binary_data_array.findtext('{*}binary') or ''
+    data = base64.b64decode(text)
+    if ZLIB_COMPRESSION in params:
+        # The size of the previous array of the same kind is a good guess of the output size, which saves the
+        # reallocations of the output buffer while decompressing
+        data = zlib.decompress(data, bufsize=buffer_sizes.get(kind, zlib.DEF_BUF_SIZE))
+        buffer_sizes[kind] = max(len(data), zlib.DEF_BUF_SIZE)
+    elif NO_COMPRESSION not in params:
+        raise UnsupportedEncoding('Binary data array with an unsupported compression (only zlib is decoded)')
+    # No copy: the array is a read-only view of the decompressed bytes
+    return kind, np.frombuffer(data, dtype=dtype)
+
+
+def _read_spectra(events, groups, rt_intervals, buffer_sizes):
+    """
+    Decode the MS1 spectra of a stream of lxml 'end' events (see iter_lxml), freeing the elements as they are read.
+    :return: generator of (retention time in minutes, m/z array, intensity array). It stops after the last interval
+    """
+    last_end = _last_end(rt_intervals)
+    for _, element in events:
+        name = _local(element.tag)
+        if name == 'spectrumList':
+            return
+        if name == 'referenceableParamGroup':
+            groups[element.get('id')] = _cv_params(element, {})
+            continue
+
+        params = _cv_params(element, groups)
+        if _ms_level(params) == 1:
+            rt = _scan_time(element, groups)
+            if rt_intervals is not None and rt > last_end:
+                return
+            if rt_intervals is None or in_rt_intervals([rt], rt_intervals)[0]:
+                arrays = {}
+                for binary_data_array in element.iterfind('{*}binaryDataArrayList/{*}binaryDataArray'):
+                    kind, array = _decode(binary_data_array, groups, buffer_sizes)
+                    if kind is not None:
+                        arrays[kind] = array
+                empty = np.empty(0, dtype=np.float64)
+                yield rt, arrays.get(MZ_ARRAY, empty), arrays.get(INTENSITY_ARRAY, empty)
+
+        # Free the spectrum and the spectra already read
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def _pull_parser():
+    return etree.XMLPullParser(events=('end',), huge_tree=True, tag=PARSED_TAGS)
+
+
+def _pull_events(parser, source, start, end, chunk_size=1 << 20):
+    """Feed the bytes [start, end) of a file to an XMLPullParser and yield its events as they come."""
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = source.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        parser.feed(chunk)
+        yield from parser.read_events()
+
+
+def spectrum_offsets(source):
+    """
+    Read the byte offsets of the spectra from the index at the end of an indexed mzML.
+    :param source: seekable binary file object (see mzml_storage.open_mzml)
+    :return: numpy array of offsets in file order, or None if the file has no usable index
+    """
+    size = source.seek(0, io.SEEK_END)
+    source.seek(max(0, size - 4096))
+    match = INDEX_LIST_OFFSET.search(source.read())
+    if match is None:
+        return None
+    source.seek(int(match.group(1)))
+    index = SPECTRUM_INDEX.search(source.read())
+    if index is None:
+        return None
+    offsets = np.array([int(offset) for offset in OFFSET.findall(index.group(1))], dtype=np.int64)
+    if not len(offsets) or np.any(np.diff(offsets) <= 0):
+        return None
+    return offsets
+
+
+def _rt_at(source, offset):
+    """Read the scan time (in minutes) of the spectrum starting at an offset, or None if it cannot be found there."""
+    source.seek(offset)
+    head = source.read(RT_PROBE_SIZE)
+    if not head.lstrip().startswith(b'<spectrum'):
+        return None
+    match = SCAN_TIME_PARAM.search(head)
+    if match is None:
+        return None
+    attributes = {name.decode(): value.decode() for name, value in ATTRIBUTE.findall(match.group(0))}
+    try:
+        rt = float(attributes['value'])
+    except (KeyError, ValueError):
+        return None
+    unit = attributes.get('unitAccession') or attributes.get('unitName')
+    return rt / 60 if unit in SECOND_UNITS else rt
+
+
+def _interval_ranges(source, offsets, rt_intervals):
+    """
+    Find the spectra of each retention time interval by binary search on the scan times of an indexed mzML.
+    :return: list of (first, last) spectrum indices (last excluded) per interval, or None if a scan time is unreadable
+    """
+    times = {}
+
+    def rt_of(i):
+        if i not in times:
+            times[i] = _rt_at(source, offsets[i])
+            if times[i] is None:
+                raise LookupError(i)
+        return times[i]
+
+    def first_after(rt, strict):
+        lo, hi = 0, len(offsets)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if rt_of(middle) > rt or (not strict and rt_of(middle) == rt):
+                hi = middle
+            else:
+                lo = middle + 1
+        return lo
+
+    try:
+        return [(first_after(start, strict=False), first_after(end, strict=True)) for start, end in rt_intervals]
+    except LookupError:
+        return None
+
+
+def _iter_indexed(source, offsets, rt_intervals, buffer_sizes):
+    """Read only the spectra inside rt_intervals, seeking to them through the spectrum offsets (see iter_lxml)."""
+    ranges = _interval_ranges(source, offsets, rt_intervals)
+    if ranges is None:
+        return None
+    # The end of the last spectrum is the end of the spectrum list
+    source.seek(offsets[-1])
+    tail = source.read()
+    list_end = tail.find(b'</spectrumList>')
+    ends = np.append(offsets[1:], offsets[-1] + (list_end if list_end >= 0 else len(tail)))
+
+    def spectra():
+        groups = {}
+        # The referenceable param groups are declared before the spectrum list
+        header = _pull_parser()
+        for _, element in _pull_events(header, source, 0, offsets[0]):
+            if _local(element.tag) == 'referenceableParamGroup':
+                groups[element.get('id')] = _cv_params(element, {})
+        for first, last in ranges:
+            if first >= last:
+                continue
+            # The spectra are parsed as a fragment, wrapped in a spectrumList
+            parser = _pull_parser()
+            parser.feed(b'<spectrumList>')
+            events = _pull_events(parser, source, offsets[first], ends[last - 1])
+            yield from _read_spectra(events, groups, rt_intervals, buffer_sizes)
+
+    return spectra()
+
+
+def iter_lxml(mzml_file_path, rt_intervals=None):
+    """
+    Iterate over the MS1 spectra of an mzML file with a lean lxml parser.
+    The mzML is parsed incrementally; the ms level and the scan time of each spectrum are read from its cvParams first,
+    and only the binary arrays of the MS1 spectra inside rt_intervals are decoded (base64, then zlib). Parsed elements
+    are freed as soon as they are read, so memory use does not grow with the file size.
+    When rt_intervals are given and the file is an indexed mzML opened with random access (plain files and blocked
+    .mzML.gz files, see mzml_storage.open_mzml), the spectra of each interval are found by binary search on the scan
+    times through the spectrum offsets of the index (the spectra of an mzML are stored in acquisition order), and only
+    their bytes are read and parsed.
+    :param mzml_file_path: path to the mzML file (.mzML or .mzML.gz, see mzml_storage.open_mzml)
+    :param rt_intervals: sorted, non-overlapping (start, end) retention time intervals in minutes. None reads every
+    spectrum
+    :return: generator of (retention time in minutes, m/z array, intensity array)
+    :raises UnsupportedEncoding: for binary arrays compressed with something else than zlib (e.g. MS-Numpress)
+    """
+    if etree is None:
+        raise ImportError('The lxml reader needs lxml (pip install lxml)')
+    if rt_intervals is not None and not rt_intervals:
+        return
+
+    buffer_sizes = {}
+    with open_mzml(mzml_file_path) as source:
+        if rt_intervals is not None and has_random_access(source):
+            offsets = spectrum_offsets(source)
+            spectra = _iter_indexed(source, offsets, rt_intervals, buffer_sizes) if offsets is not None else None
+            if spectra is not None:
+                yield from spectra
+                return
+            source.seek(0)
+
+        # Everything after the spectrum list (chromatograms, index) is never parsed
+        context = etree.iterparse(source, events=('end',), huge_tree=True, tag=PARSED_TAGS)
+        try:
+            yield from _read_spectra(context, {}, rt_intervals, buffer_sizes)
+        finally:
+            del context
+
+
+READERS = {'lxml': iter_lxml, 'pymzml': iter_pymzml}
+
+
+def iter_spectra(mzml_file_path, rt_intervals=None, reader=DEFAULT_READER):
+    """
+    Iterate over the MS1 spectra of an mzML file with one of the READERS.
+    'auto' uses the lxml backend when lxml is installed and falls back to pymzml otherwise. It also falls back to
+    pymzml for files whose binary arrays the lxml backend cannot decode, continuing after the spectra already read.
+    :param mzml_file_path: path to the mzML file
+    :param rt_intervals: retention time intervals to read (see iter_lxml). None reads every spectrum
+    :param reader: 'auto', 'lxml' or 'pymzml'
+    :return: generator of (retention time in minutes, m/z array, intensity array)
+    """
+    if reader != DEFAULT_READER:
+        if reader not in READERS:
+            raise ValueError(f"Unknown mzML reader '{reader}', expected one of {[DEFAULT_READER, *READERS]}")
+        yield from READERS[reader](mzml_file_path, rt_intervals)
+        return
+
+    if etree is None:
+        yield from iter_pymzml(mzml_file_path, rt_intervals)
+        return
+    n_read = 0
+    try:
+        for scan in iter_lxml(mzml_file_path, rt_intervals):
+            yield scan
+            n_read += 1
+        return
+    except UnsupportedEncoding:
+        pass
+    # Both readers walk the spectra in file order, so the first n_read spectra were already yielded
+    for i, scan in enumerate(iter_pymzml(mzml_file_path, rt_intervals)):
+        if i >= n_read:
+            yield scan
+
+
+def benchmark(mzml_file_path, readers=None, rt_intervals=None, repeat=3) -> dict:
+    """
+    Measure the throughput of the readers on an mzML file, and check that they return the same spectra.
+    :param mzml_file_path: path to the mzML file
+    :param readers: names of the READERS to compare. None compares all the available ones
+    :param rt_intervals: retention time intervals to read (see iter_lxml)
+    :param repeat: number of full reads per reader; the fastest one is kept
+    :return: dict mapping each reader to a dict with 'seconds', 'scans', 'peaks', 'scans_per_second',
+    'mb_per_second' and 'speedup' (relative to pymzml)
+    """
+    if readers is None:
+        readers = [name for name in READERS if name != 'lxml' or etree is not None]
+    size_mb = os.path.getsize(mzml_file_path) / 1e6
+    results = {}
+    checksums = {}
+    for name in readers:
+        best = np.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            scans = peaks = 0
+            total = 0.0
+            for rt, mz, intensity in READERS[name](mzml_file_path, rt_intervals):
+                scans += 1
+                peaks += len(mz)
+                total += float(np.sum(intensity, dtype=np.float64))
+            best = min(best, time.perf_counter() - start)
+        checksums[name] = (scans, peaks, total)
+        results[name] = {'seconds': best, 'scans': scans, 'peaks': peaks, 'scans_per_second': scans / best,
+                         'mb_per_second': size_mb / best}
+    for name, result in results.items():
+        result['speedup'] = results['pymzml']['seconds'] / result['seconds'] if 'pymzml' in results else np.nan
+
+    reference = next(iter(checksums.values()))
+    for name, (scans, peaks, total) in checksums.items():
+        if (scans, peaks) != reference[:2] or not np.isclose(total, reference[2], rtol=1e-6):
+            print(f"Warning: the {name} reader returned {scans} scans / {peaks} peaks, expected "
+                  f"{reference[0]} scans / {reference[1]} peaks")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MS1 readers of the XIC pipeline on mzML files")
+    parser.add_argument('mzml_files', nargs='+', help='mzML files to read')
+    parser.add_argument('--readers', nargs='+', choices=list(READERS), default=None,
+                        help='Readers to compare (default: all the available ones)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of reads per reader, the fastest is kept (default: 3)')
+    args = parser.parse_args()
+
+    for mzml_file_path in args.mzml_files:
+        print(mzml_file_path)
+        for name, result in benchmark(mzml_file_path, args.readers, repeat=args.repeat).items():
+            print(f"  {name:>7}: {result['seconds']:.3f} s, {result['scans']} MS1 scans, "
+                  f"{result['scans_per_second']:.0f} scans/s, {result['mb_per_second']:.1f} MB/s, "
+                  f"x{result['speedup']:.1f} vs pymzml")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import argparse
+import gzip
+import io
+import os
+import zlib
+
+import numpy as np
+
+try:
+    import indexed_gzip
+except ImportError:  # gzip files without a block index are then read sequentially
+    indexed_gzip = None
+
+GZIP_SUFFIX = '.gz'
+INDEX_SUFFIX = '.idx'
+BLOCK_SIZE = 1 << 20  # uncompressed bytes per gzip member
+COMPRESS_LEVEL = 6
+
+
+def stored_path(mzml_file_path: str) -> str:
+    """
+    Get the path under which an mzML file is stored: the file itself, or its compressed copy (file.mzML.gz).
+    :param mzml_file_path: path to the mzML file, as named in the input TSVs
+    :return: path of the existing file, or mzml_file_path if neither exists
+    """
+    if not os.path.exists(mzml_file_path) and os.path.exists(mzml_file_path + GZIP_SUFFIX):
+        return mzml_file_path + GZIP_SUFFIX
+    return mzml_file_path
+
+
+def remove_stored(file_path: str):
+    """Delete a stored mzML file and, for compressed files, its block index."""
+    os.remove(file_path)
+    if os.path.exists(file_path + INDEX_SUFFIX):
+        os.remove(file_path + INDEX_SUFFIX)
+
+
+class BlockedGzipWriter:
+    """
+    Write a file as a series of independent gzip members of BLOCK_SIZE uncompressed bytes each, so it stays a valid
+    .gz file (readable by gzip, zcat, pymzml...) that can also be read from any offset by decompressing one block
+    (see BlockedGzipFile).
+    The end offsets (compressed, uncompressed) of every block are appended to the '<path>.idx' sidecar as the blocks
+    are written, so a write that was interrupted can be resumed after the last complete block.
+    """
+
+    def __init__(self, path: str, resume=False, block_size=BLOCK_SIZE, compresslevel=COMPRESS_LEVEL):
+        """
+        :param path: path of the compressed file
+        :param resume: keep the complete blocks of an existing file and append after them (see raw_size)
+        :param block_size: uncompressed bytes per gzip member
+        :param compresslevel: zlib compression level, 1 (fastest) to 9 (smallest)
+        """
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self._buffer = bytearray()
+
+        ends = np.zeros((0, 2), dtype=np.int64)
+        if resume and os.path.exists(path) and os.path.exists(self.index_path):
+            ends = _read_index(self.index_path)
+            # Drop a block whose data did not reach the disk
+            ends = ends[ends[:, 0] <= os.path.getsize(path)]
+        self.compressed_size, self.raw_size = (int(value) for value in ends[-1]) if len(ends) else (0, 0)
+
+        self._file = open(path, 'r+b' if len(ends) else 'wb')
+        self._file.truncate(self.compressed_size)
+        self._file.seek(self.compressed_size)
+        with open(self.index_path, 'wb') as f:
+            f.write(ends.tobytes())
+        self._index = open(self.index_path, 'ab')
+
+    def _write_block(self, data):
+        member = gzip.compress(data, compresslevel=self.compresslevel, mtime=0)
+        self._file.write(member)
+        self.compressed_size += len(member)
+        self.raw_size += len(data)
+        # The index must never point past the data on disk
+        self._file.flush()
+        self._index.write(np.array([self.compressed_size, self.raw_size], dtype=np.int64).tobytes())
+        self._index.flush()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._write_block(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer.clear()
+        self._file.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read_index(index_path):
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    # A block end being written when the process stopped leaves a truncated record
+    data = data[:len(data) - len(data) % 16]
+    return np.frombuffer(data, dtype=np.int64).reshape(-1, 2)
+
+
+class BlockedGzipFile(io.RawIOBase):
+    """
+    Seekable reader of a file written by BlockedGzipWriter. Seeking to any uncompressed offset (e.g. the offset of a
+    spectrum in the index of an indexed mzML) only decompresses the block holding it.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        ends = _read_index(path + INDEX_SUFFIX)
+        self._compressed = np.concatenate(([0], ends[:, 0]))
+        self._raw = np.concatenate(([0], ends[:, 1]))
+        self._file = open(path, 'rb')
+        self._position = 0
+        self._block = -1
+        self._data = b''
+
+    @property
+    def size(self) -> int:
+        return int(self._raw[-1])
+
+    def _load(self, block):
+        if block != self._block:
+            self._file.seek(self._compressed[block])
+            member = self._file.read(self._compressed[block + 1] - self._compressed[block])
+            self._data = zlib.decompress(member, wbits=31)
+            self._block = block
+
+    def readinto(self, buffer):
+        if self._position >= self.size:
+            return 0
+        block = int(np.searchsorted(self._raw, self._position, side='right')) - 1
+        self._load(block)
+        start = self._position - int(self._raw[block])
+        n = min(len(buffer), len(self._data) - start)
+        memoryview(buffer)[:n] = memoryview(self._data)[start:start + n]
+        self._position += n
+        return n
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'Negative seek position {offset}')
+        self._position = offset
+        return offset
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_mzml(file_path: str, buffer_size=BLOCK_SIZE):
+    """
+    Open a stored mzML file for binary reading, plain or compressed.
+    Files written by BlockedGzipWriter (with a '.idx' block index) are opened with random access. Other gzip files use
+    indexed_gzip when it is installed (random access after a first pass), or the gzip module (sequential).
+    :param file_path: path to the .mzML or .mzML.gz file (see stored_path)
+    :param buffer_size: read buffer size in bytes
+    :return: seekable binary file object
+    """
+    if not file_path.endswith(GZIP_SUFFIX):
+        return open(file_path, 'rb', buffering=buffer_size)
+    if os.path.exists(file_path + INDEX_SUFFIX):
+        return io.BufferedReader(BlockedGzipFile(file_path), buffer_size=buffer_size)
+    if indexed_gzip is not None:
+        return indexed_gzip.IndexedGzipFile(file_path)
+    return gzip.open(file_path, 'rb')
+
+
+def has_random_access(source) -> bool:
+    """Check if a file returned by open_mzml can seek without decompressing everything before the target offset."""
+    return not isinstance(source, gzip.GzipFile)
+
+
+def compress_file(mzml_file_path: str, remove=False, block_size=BLOCK_SIZE, compresslevel=COMPRESS_LEVEL) -> str:
+    """
+    Compress a plain mzML file into a blocked gzip file (file.mzML.gz and its block index).
+    :param mzml_file_path: path to the mzML file
+    :param remove: delete the plain file once compressed
+    :param block_size: uncompressed bytes per gzip member
+    :param compresslevel: zlib compression level
+    :return: path of the compressed file
+    """
+    gz_path = mzml_file_path + GZIP_SUFFIX
+    part_path = gz_path + '.part'
+    with open(mzml_file_path, 'rb') as source, BlockedGzipWriter(part_path, block_size=block_size,
+                                                                 compresslevel=compresslevel) as writer:
+        while True:
+            data = source.read(block_size)
+            if not data:
+                break
+            writer.write(data)
+    os.replace(part_path + INDEX_SUFFIX, gz_path + INDEX_SUFFIX)
+    os.replace(part_path, gz_path)
+    if remove:
+        os.remove(mzml_file_path)
+    return gz_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compress downloaded mzML files into random-access gzip files")
+    parser.add_argument('mzml_files', nargs='+', help='mzML files to compress')
+    parser.add_argument('--remove', action='store_true', help='Delete each mzML file once compressed')
+    parser.add_argument('--level', type=int, default=COMPRESS_LEVEL,
+                        help=f'Compression level, 1 (fastest) to 9 (smallest) (default: {COMPRESS_LEVEL})')
+    args = parser.parse_args()
+
+    for mzml_file_path in args.mzml_files:
+        gz_path = compress_file(mzml_file_path, remove=args.remove, compresslevel=args.level)
+        with BlockedGzipFile(gz_path) as f:
+            raw_size = f.size
+        print(f"{gz_path}: {raw_size / 1e6:.1f} MB -> {os.path.getsize(gz_path) / 1e6:.1f} MB "
+              f"(x{raw_size / max(1, os.path.getsize(gz_path)):.1f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import base64
+import zlib
+
+import numpy as np
+import pytest
+
+import mzml_readers
+from mzml_readers import iter_lxml, iter_pymzml
+from mzml_storage import compress_file
+
+N_SPECTRA = 300
+
+
+def _binary_array(values, dtype, accession, name):
+    data = base64.b64encode(zlib.compress(np.asarray(values, dtype=dtype).tobytes())).decode()
+    precision = ('<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>' if dtype == np.float64
+                 else '<cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>')
+    return (f'<binaryDataArray encodedLength="{len(data)}">{precision}'
+            '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+            f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>'
+            f'<binary>{data}</binary></binaryDataArray>')
+
+
+def _spectrum(index):
+    ms_level = 1 if index % 3 == 0 else 2
+    mz = 100 + np.arange(5) + index / 1000
+    intensity = (index + 1) * np.arange(1, 6)
+    return (f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="5">'
+            f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>'
+            '<scanList count="1"><scan>'
+            f'<cvParam cvRef="MS" accession="MS:1000016" name="scan start time" value="{index / 30}" '
+            'unitCvRef="UO" unitAccession="UO:0000031" unitName="minute"/>'
+            '</scan></scanList><binaryDataArrayList count="2">'
+            + _binary_array(mz, np.float64, 'MS:1000514', 'm/z array')
+            + _binary_array(intensity, np.float32, 'MS:1000515', 'intensity array')
+            + '</binaryDataArrayList></spectrum>\n')
+
+
+@pytest.fixture
+def indexed_mzml(tmp_path):
+    head = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n'
+            '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+            '<run id="run"><spectrumList count="%d">\n' % N_SPECTRA).encode()
+    content = bytearray(head)
+    offsets = []
+    for index in range(N_SPECTRA):
+        offsets.append(len(content))
+        content += _spectrum(index).encode()
+    content += b'</spectrumList></run></mzML>\n'
+    index_offset = len(content)
+    content += b'<indexList count="1"><index name="spectrum">\n'
+    for index, offset in enumerate(offsets):
+        content += f'<offset idRef="scan={index + 1}">{offset}</offset>\n'.encode()
+    content += f'</index></indexList>\n<indexListOffset>{index_offset}</indexListOffset>\n'.encode()
+    content += b'</indexedmzML>\n'
+
+    path = tmp_path / 'run.mzML'
+    path.write_bytes(bytes(content))
+    return str(path)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('rt_intervals', [None, [(1.0, 2.0), (4.5, 6.0)], [(0, 0.1)], [(9.5, 20)], [(20, 30)]])
+def test_lxml_reader_matches_pymzml(indexed_mzml, rt_intervals, compressed):
+    expected = list(iter_pymzml(indexed_mzml, rt_intervals))
+    path = compress_file(indexed_mzml, remove=True) if compressed else indexed_mzml
+    spectra = list(iter_lxml(path, rt_intervals))
+
+    assert [rt for rt, _, _ in spectra] == pytest.approx([rt for rt, _, _ in expected])
+    for (_, mz, intensity), (_, expected_mz, expected_intensity) in zip(spectra, expected):
+        np.testing.assert_allclose(mz, expected_mz)
+        np.testing.assert_allclose(intensity, expected_intensity)
+
+
+def test_rt_windows_seek_through_the_index(indexed_mzml, monkeypatch):
+    path = compress_file(indexed_mzml, remove=True)
+    # The whole-file parser must not be needed when the index is usable
+    monkeypatch.setattr(mzml_readers.etree, 'iterparse', None)
+    rts = [rt for rt, _, _ in iter_lxml(path, [(4.5, 5.0)])]
+    assert rts == pytest.approx([index / 30 for index in range(135, 151) if index % 3 == 0])
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from xic_peaks import find_peaks
+
+SIGMA = 0.05
+
+
+def gaussian(rt, apex=5.0, height=1e6, sigma=SIGMA):
+    return height * np.exp(-0.5 * ((rt - apex) / sigma) ** 2)
+
+
+def test_noisy_peak_is_not_cut_at_wiggles():
+    rt = np.arange(4.0, 6.0, 0.005)
+    rng = np.random.default_rng(0)
+    trace = gaussian(rt) * (1 + 0.03 * rng.standard_normal(len(rt)))
+    summary = find_peaks(rt, trace[:, None], max_half_width=0.3)
+
+    true_area = 1e6 * SIGMA * np.sqrt(2 * np.pi)
+    assert abs(summary['peak_area'][0] / true_area - 1) < 0.03
+    # 1% of the apex height is reached about 3 sigma away from it
+    assert abs(summary['peak_start_rt'][0] - (5 - 3 * SIGMA)) <= 0.02
+    assert abs(summary['peak_end_rt'][0] - (5 + 3 * SIGMA)) <= 0.02
+    assert abs(summary['fwhm'][0] - 2.3548 * SIGMA) < 0.01
+
+
+def test_coeluting_peak_is_cut_at_the_valley():
+    rt = np.arange(4.0, 6.0, 0.01)
+    trace = gaussian(rt) + gaussian(rt, apex=5.25, height=6e5)
+    summary = find_peaks(rt, trace[:, None], max_half_width=0.5)
+    assert 5.1 < summary['peak_end_rt'][0] < 5.2
+    assert summary['peak_area'][0] < 1.05 * 1e6 * SIGMA * np.sqrt(2 * np.pi)
+
+
+def test_sparse_trace_has_finite_signal_to_noise():
+    rt = np.arange(0, 10, 0.05)
+    trace = np.zeros(len(rt))
+    trace[98:103] = [200, 5000, 20000, 5000, 200]
+    summary = find_peaks(rt, trace[:, None])
+    assert np.isfinite(summary['signal_to_noise'][0])
+    assert summary['signal_to_noise'][0] > 1
+
+
+def test_empty_trace_has_nan_signal_to_noise():
+    rt = np.arange(0, 1, 0.1)
+    summary = find_peaks(rt, np.zeros((len(rt), 1)))
+    assert np.isnan(summary['signal_to_noise'][0])
+
+
+@pytest.mark.filterwarnings('error')
+def test_points_outside_the_window_raise_no_warnings():
+    rt = np.arange(4.0, 6.0, 0.01)
+    trace = np.column_stack([gaussian(rt), gaussian(rt, apex=5.3)])
+    valid = np.ones(trace.shape, dtype=bool)
+    valid[:50, 0] = False
+    valid[150:, 1] = False
+    summary = find_peaks(rt, trace, valid=valid, max_half_width=0.3)
+    assert summary['peak_rt'][0] == pytest.approx(5.0)
+    assert np.all(np.isfinite(summary['peak_area']))
+
+
+def test_smoothed_one_scan_spike_reports_the_raw_apex():
+    rt = np.round(np.arange(4.0, 6.0, 0.02), 2)
+    trace = np.zeros(len(rt))
+    trace[50] = 1e5
+    summary = find_peaks(rt, trace[:, None], smooth_window=5)
+    assert summary['peak_rt'][0] == pytest.approx(rt[50])
+    assert summary['peak_intensity'][0] == 1e5
+    assert summary['peak_start_rt'][0] <= rt[50] <= summary['peak_end_rt'][0]
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from xic_peaks import PEAK_COLUMNS
+
+
+def job_hash(params: dict, rows, job: dict) -> str:
+    """
+    Hash the parameters that determine the results of one mzML file: the extraction settings, the rows of the file in
+    the input table and its targets (m/z and retention time windows).
+    :param params: extraction settings (e.g. ppm_tolerance, rt_tolerance, smooth_window)
+    :param rows: row labels of the file in the input table
+    :param job: summarize_file arguments of the file (see xic_engine.file_jobs)
+    :return: hex digest
+    """
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    digest.update(json.dumps([str(row) for row in rows]).encode())
+    for key in ('target_mzs', 'rt_min', 'rt_max'):
+        value = job.get(key)
+        digest.update(key.encode())
+        if value is not None:
+            digest.update(np.asarray(value, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class XicCheckpoint:
+    """
+    Incremental store of the XIC results of a run, so an interrupted run resumes where it stopped.
+    The results of each mzML file are appended to '<results>.partial.tsv' as soon as the file is processed, and
+    '<results>.manifest.json' records the size, modification time and parameter hash of every completed file.
+    A file is processed again when it changed or when its parameters (settings, rows or targets) changed.
+    """
+
+    def __init__(self, result_dir: str, result_filename: str):
+        os.makedirs(result_dir, exist_ok=True)
+        self.store_path = os.path.join(result_dir, f'{result_filename}.partial.tsv')
+        self.manifest_path = os.path.join(result_dir, f'{result_filename}.manifest.json')
+        self._lock = threading.Lock()
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+
+    @staticmethod
+    def _signature(mzml_file_path):
+        if not os.path.exists(mzml_file_path):
+            return None
+        stat = os.stat(mzml_file_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def is_done(self, mzml_file: str, mzml_file_path: str, params_hash: str) -> bool:
+        """
+        Check if a file was already processed with the same parameters. A file that was deleted after processing
+        (e.g. with --delete-processed) still counts as done.
+        """
+        entry = self.manifest.get(mzml_file)
+        if entry is None or entry['params'] != params_hash:
+            return False
+        signature = self._signature(mzml_file_path)
+        return signature is None or signature == entry['signature']
+
+    def load(self, df: pd.DataFrame, mzml_files) -> int:
+        """
+        Copy the stored results of completed files into the DataFrame.
+        :param df: input DataFrame with the PEAK_COLUMNS
+        :param mzml_files: names of the files whose results are loaded
+        :return: number of rows filled in
+        """
+        mzml_files = set(mzml_files)
+        if not mzml_files or not os.path.exists(self.store_path):
+            return 0
+        stored = pd.read_csv(self.store_path, sep='\t', dtype={'row': str})
+        # A crash between appending the results and updating the manifest leaves duplicates; the last ones win
+        stored = stored[stored['Filename'].isin(mzml_files)].drop_duplicates('row', keep='last')
+        labels = {str(label): label for label in df.index}
+        stored = stored[stored['row'].isin(labels)]
+        df.loc[[labels[row] for row in stored['row']], PEAK_COLUMNS] = stored[PEAK_COLUMNS].to_numpy()
+        return len(stored)
+
+    def record(self, mzml_file: str, mzml_file_path: str, params_hash: str, rows, summary: dict):
+        """
+        Append the results of a processed file to the store, then mark it as done in the manifest.
+        :param mzml_file: file name, as in the Filename column
+        :param mzml_file_path: path of the mzML file
+        :param params_hash: see job_hash
+        :param rows: row labels of the file in the input table
+        :param summary: results of summarize_file
+        """
+        results = pd.DataFrame({column: summary[column] for column in PEAK_COLUMNS})
+        results.insert(0, 'Filename', mzml_file)
+        results.insert(0, 'row', [str(row) for row in rows])
+        with self._lock:
+            results.to_csv(self.store_path, sep='\t', index=False, mode='a',
+                           header=not os.path.exists(self.store_path))
+            self.manifest[mzml_file] = {'params': params_hash, 'signature': self._signature(mzml_file_path)}
+            tmp_path = f'{self.manifest_path}.tmp-{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,219 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from ms1_cache import Ms1CacheWriter, load_cache
+from mzml_readers import DEFAULT_READER, iter_spectra
+from mzml_storage import stored_path
+from xic_peaks import find_peaks
+
+# Optional columns of the input TSVs with the expected retention time window (in minutes) of each target
+RT_MIN_COLUMN = 'RT_min'
+RT_MAX_COLUMN = 'RT_max'
+
+
+def ppm_windows(target_mzs, ppm_tolerance=10):
+    """
+    Compute the m/z window around each target.
+    :param target_mzs: array-like with the target m/z values
+    :param ppm_tolerance: tolerance in ppm
+    :return: tuple of (lower bounds, upper bounds) as numpy arrays
+    """
+    target_mzs = np.asarray(target_mzs, dtype=np.float64)
+    mz_tolerance = target_mzs * (ppm_tolerance / 1e6)
+    return target_mzs - mz_tolerance, target_mzs + mz_tolerance
+
+
+def rt_bounds(n_targets, rt_min=None, rt_max=None):
+    """
+    Normalize the retention time windows of the targets. Missing bounds (None or NaN) are open.
+    :param n_targets: number of targets
+    :param rt_min: array-like with the start of each window in minutes, or None
+    :param rt_max: array-like with the end of each window in minutes, or None
+    :return: tuple of (starts, ends) as numpy arrays, with -inf/inf for open bounds
+    """
+    starts = np.full(n_targets, -np.inf) if rt_min is None else np.asarray(rt_min, dtype=np.float64).copy()
+    ends = np.full(n_targets, np.inf) if rt_max is None else np.asarray(rt_max, dtype=np.float64).copy()
+    starts[np.isnan(starts)] = -np.inf
+    ends[np.isnan(ends)] = np.inf
+    return starts, ends
+
+
+def merge_rt_windows(starts, ends):
+    """
+    Merge the retention time windows of all targets into the sorted, non-overlapping intervals covering them.
+    :param starts: start of each window in minutes (-inf if open)
+    :param ends: end of each window in minutes (inf if open)
+    :return: list of (start, end) intervals, or None if the windows cover the whole run
+    """
+    if len(starts) == 0:
+        return []
+    if np.any(np.isneginf(starts) & np.isposinf(ends)):
+        return None
+    intervals = []
+    for start, end in sorted(zip(starts.tolist(), ends.tolist())):
+        if intervals and start <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], end)
+        else:
+            intervals.append([start, end])
+    return [tuple(interval) for interval in intervals]
+
+
+def window_sums(mz, intensity, mz_min, mz_max):
+    """
+    Sum the intensities of the peaks falling inside each [mz_min, mz_max] window.
+    Uses a cumulative sum and binary search, so the cost is O(peaks + targets * log(peaks)).
+    :param mz: m/z array of a spectrum
+    :param intensity: intensity array of a spectrum
+    :param mz_min: sorted lower bounds of the windows
+    :param mz_max: upper bounds of the windows (same order as mz_min)
+    :return: numpy array with the summed intensity per window
+    """
+    if len(mz) > 1 and np.any(mz[1:] < mz[:-1]):
+        order = np.argsort(mz, kind="stable")
+        mz, intensity = mz[order], intensity[order]
+    cumulative = np.zeros(len(intensity) + 1, dtype=np.float64)
+    np.cumsum(intensity, out=cumulative[1:])
+    lo = np.searchsorted(mz, mz_min, side="left")
+    hi = np.searchsorted(mz, mz_max, side="right")
+    return cumulative[hi] - cumulative[lo]
+
+
+def iter_ms1_scans(mzml_file_path, use_cache=True, cache_dir=None, rt_intervals=None, reader=DEFAULT_READER):
+    """
+    Iterate over the MS1 spectra of an mzML file.
+    When use_cache is True, the scans are read from the memory-mapped MS1 cache of the file, which is
+    written during the first full read (see ms1_cache.py).
+    :param mzml_file_path: path to the mzML file. Its compressed copy (file.mzML.gz) is read if the plain file is not
+    on disk (see mzml_storage.py)
+    :param use_cache: read from (and write to) the sidecar MS1 cache
+    :param cache_dir: folder where the caches are kept. If None, they are saved next to the mzML files
+    :param rt_intervals: sorted, non-overlapping (start, end) retention time intervals in minutes (see
+    merge_rt_windows). Only the spectra inside them are decoded. None reads every spectrum
+    :param reader: mzML reader used when the scans are not cached: 'auto', 'lxml' or 'pymzml' (see mzml_readers.py)
+    :return: generator of (retention time in minutes, m/z array, intensity array)
+    """
+    mzml_file_path = stored_path(mzml_file_path)
+    if use_cache:
+        cache = load_cache(mzml_file_path, cache_dir)
+        if cache is not None:
+            yield from cache.iter_scans(rt_intervals)
+            return
+
+        # The cache holds every scan, so it is only written by full reads
+        if rt_intervals is None:
+            with Ms1CacheWriter(mzml_file_path, cache_dir) as writer:
+                for rt, mz, intensity in iter_ms1_scans(mzml_file_path, use_cache=False, reader=reader):
+                    writer.add(rt, mz, intensity)
+                    yield rt, mz, intensity
+            return
+
+    yield from iter_spectra(mzml_file_path, rt_intervals, reader)
+
+
+def extract_xics(mzml_file_path, target_mzs, ppm_tolerance=10, use_cache=True, cache_dir=None, rt_intervals=None,
+                 reader=DEFAULT_READER):
+    """
+    Extract the ion chromatograms of all targets from an mzML file in a single pass.
+    :param mzml_file_path: path to the mzML file
+    :param target_mzs: array-like with the target m/z values
+    :param ppm_tolerance: tolerance in ppm used to build the m/z windows
+    :param use_cache: read the scans through the MS1 cache (see iter_ms1_scans)
+    :param cache_dir: folder where the caches are kept
+    :param rt_intervals: retention time intervals to read (see iter_ms1_scans). None reads the whole run
+    :param reader: mzML reader (see iter_ms1_scans)
+    :return: tuple of (retention times with shape (n_scans,), intensities with shape (n_scans, n_targets))
+    """
+    target_mzs = np.asarray(target_mzs, dtype=np.float64)
+    # Sort the targets once so the binary searches walk the spectrum in order
+    order = np.argsort(target_mzs, kind="stable")
+    mz_min, mz_max = ppm_windows(target_mzs[order], ppm_tolerance)
+
+    rt_values = []
+    xic_rows = []
+    for rt, mz, intensity in iter_ms1_scans(mzml_file_path, use_cache, cache_dir, rt_intervals, reader):
+        rt_values.append(rt)
+        xic_rows.append(window_sums(mz, intensity, mz_min, mz_max))
+
+    xic = np.empty((len(xic_rows), len(target_mzs)), dtype=np.float64)
+    if xic_rows:
+        xic[:, order] = np.vstack(xic_rows)
+    return np.asarray(rt_values, dtype=np.float64), xic
+
+
+def summarize_file(mzml_file_path, target_mzs, ppm_tolerance=10, rt_tolerance=0.3, use_cache=True, cache_dir=None,
+                   rt_min=None, rt_max=None, smooth_window=1, reader=DEFAULT_READER):
+    """
+    Extract the ion chromatograms of all targets of one mzML file and integrate their peaks as one 2-D batch.
+    When retention time windows are given, only the spectra inside their union are decoded, and the trace of each
+    target is restricted to its own window.
+    :param mzml_file_path: path to the mzML file
+    :param target_mzs: array-like with the target m/z values
+    :param ppm_tolerance: tolerance in ppm used to build the m/z windows
+    :param rt_tolerance: maximum distance (in minutes) between the apex and each peak boundary
+    :param use_cache: read the scans through the MS1 cache (see iter_ms1_scans)
+    :param cache_dir: folder where the caches are kept
+    :param rt_min: array-like with the start (in minutes) of the expected window of each target, NaN for none
+    :param rt_max: array-like with the end (in minutes) of the expected window of each target, NaN for none
+    :param smooth_window: number of scans of the moving average applied before peak detection
+    :param reader: mzML reader (see iter_ms1_scans)
+    :return: dict mapping each of xic_peaks.PEAK_COLUMNS to an array with one value per target
+    """
+    starts, ends = rt_bounds(len(target_mzs), rt_min, rt_max)
+    rt_values, xic = extract_xics(mzml_file_path, target_mzs, ppm_tolerance, use_cache, cache_dir,
+                                  rt_intervals=merge_rt_windows(starts, ends), reader=reader)
+    valid = (rt_values[:, None] >= starts) & (rt_values[:, None] <= ends)
+    return find_peaks(rt_values, xic, valid, smooth_window=smooth_window, max_half_width=rt_tolerance)
+
+
+def file_jobs(df, mzml_dir, file_groups=None):
+    """
+    Build the summarize_file arguments of each mzML file of an input table.
+    :param df: DataFrame with the Filename and Prec_mz columns, and optionally RT_min and RT_max
+    :param mzml_dir: folder where the mzML files are stored
+    :param file_groups: row labels of each file, as returned by df.groupby('Filename').groups. Computed if None
+    :return: dict mapping each mzML file path to a dict with target_mzs, rt_min and rt_max
+    """
+    if file_groups is None:
+        file_groups = df.groupby('Filename', sort=False).groups
+    jobs = {}
+    for mzml_file, rows in file_groups.items():
+        jobs[os.path.join(mzml_dir, mzml_file)] = {
+            'target_mzs': df.loc[rows, 'Prec_mz'].to_numpy(),
+            'rt_min': df.loc[rows, RT_MIN_COLUMN].to_numpy() if RT_MIN_COLUMN in df.columns else None,
+            'rt_max': df.loc[rows, RT_MAX_COLUMN].to_numpy() if RT_MAX_COLUMN in df.columns else None,
+        }
+    return jobs
+
+
+def map_files(jobs: dict, workers=1, **kwargs):
+    """
+    Run summarize_file for several mzML files, optionally in a process pool.
+    A file that fails does not stop the others; its exception is returned instead of the result.
+    :param jobs: dict mapping each mzML file path to its target m/z values, or to a dict of summarize_file arguments
+    (target_mzs, rt_min, rt_max) as built by file_jobs
+    :param workers: number of worker processes. 1 runs everything in the current process
+    :param kwargs: extra arguments passed to summarize_file
+    :return: generator of (mzml file path, summary, exception), in order of completion. The summary maps each of
+    xic_peaks.PEAK_COLUMNS to an array with one value per target
+    """
+    jobs = {mzml_file_path: job if isinstance(job, dict) else {'target_mzs': job} for mzml_file_path, job in jobs.items()}
+    if workers <= 1:
+        for mzml_file_path, job in jobs.items():
+            try:
+                yield mzml_file_path, summarize_file(mzml_file_path, **job, **kwargs), None
+            except Exception as e:
+                yield mzml_file_path, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(summarize_file, mzml_file_path, **job, **kwargs): mzml_file_path
+            for mzml_file_path, job in jobs.items()
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
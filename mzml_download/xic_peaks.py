@@ -0,0 +1,176 @@
+import warnings
+
+import numpy as np
+
+# Columns of the summary returned by find_peaks, in the order they are written to the result TSVs
+PEAK_COLUMNS = ['area_under_curve', 'peak_area', 'peak_rt', 'peak_intensity', 'peak_start_rt', 'peak_end_rt', 'fwhm',
+                'signal_to_noise']
+
+
+def smooth(xic, window=1):
+    """
+    Centered moving average of each trace (column) of a 2-D XIC array.
+    :param xic: intensities with shape (n_scans, n_targets)
+    :param window: number of scans averaged. 1 returns the traces unchanged
+    :return: smoothed array with the same shape
+    """
+    if window <= 1 or len(xic) == 0:
+        return xic
+    half = window // 2
+    padded = np.pad(xic, ((half, window - 1 - half), (0, 0)), mode='edge')
+    cumulative = np.zeros((len(padded) + 1, xic.shape[1]), dtype=np.float64)
+    np.cumsum(padded, axis=0, out=cumulative[1:])
+    return (cumulative[window:] - cumulative[:-window]) / window
+
+
+def estimate_baseline(xic, valid, quantile=0.1):
+    """
+    Estimate the baseline and the noise of each trace. The baseline is a low quantile of the valid points, and the
+    noise is the scaled median absolute deviation from it of the points below the median (the background), so a peak
+    filling most of a narrow retention time window does not inflate either.
+    Narrow XICs are mostly zeros, which makes that deviation 0. The noise then falls back to the standard deviation of
+    the background, and if the background is flat too, to the smallest non-zero intensity of the trace (the detection
+    limit). It is NaN only for traces without any non-zero point.
+    :param xic: intensities with shape (n_scans, n_targets)
+    :param valid: boolean mask of the points of each trace to use
+    :param quantile: quantile of the points used as baseline
+    :return: tuple of (baseline, noise) arrays with shape (n_targets,)
+    """
+    values = np.where(valid, xic, np.nan)
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        # Traces without valid points give all-NaN columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        baseline = np.nanquantile(values, quantile, axis=0)
+        background = np.where(values <= np.nanmedian(values, axis=0), values, np.nan)
+        noise = 1.4826 * np.nanmedian(np.abs(background - baseline), axis=0)
+        noise = np.where(noise > 0, noise, np.nanstd(background, axis=0))
+        noise = np.where(noise > 0, noise, np.nanmin(np.where(values > 0, values, np.nan), axis=0))
+    return baseline, noise
+
+
+def _crossing(rt, trace, left, right, level):
+    """Linear interpolation of the retention time where each trace crosses `level` between indices left and right."""
+    columns = np.arange(trace.shape[1])
+    y0, y1 = trace[left, columns], trace[right, columns]
+    with np.errstate(all='ignore'):
+        fraction = np.where(y1 != y0, (level - y0) / (y1 - y0), 0.0)
+    return rt[left] + np.clip(fraction, 0, 1) * (rt[right] - rt[left])
+
+
+def find_peaks(rt, xic, valid=None, smooth_window=1, max_half_width=None, boundary_fraction=0.01, valley_fraction=0.1,
+               valley_noise=3.0):
+    """
+    Detect and integrate the main peak of every trace of a 2-D XIC array at once.
+    The apex is the highest point of the (optionally smoothed) trace. The peak extends on both sides until the trace
+    falls back to the baseline (within boundary_fraction of the apex height) or reaches a valley, so a co-eluting peak is
+    not integrated with it, and at most max_half_width minutes from the apex. peak_rt and peak_intensity are then read
+    from the raw trace, at its highest point between the boundaries.
+    A valley is a local minimum after which the trace rises again (further away from the apex) by more than
+    valley_fraction of the apex height above the baseline and more than valley_noise times the noise, so the wiggles of
+    a noisy peak do not cut it.
+    :param rt: retention times in minutes, shape (n_scans,), in increasing order
+    :param xic: intensities with shape (n_scans, n_targets)
+    :param valid: boolean mask with the same shape as xic, False for the points outside the retention time window
+    of a target. None uses every point
+    :param smooth_window: number of scans of the moving average applied before peak detection
+    :param max_half_width: maximum distance in minutes between the apex and each peak boundary. None for no limit
+    :param boundary_fraction: fraction of the apex height above the baseline under which the trace is considered back
+    at the baseline
+    :param valley_fraction: minimum rise after a valley, as a fraction of the apex height above the baseline
+    :param valley_noise: minimum rise after a valley, in multiples of the noise
+    :return: dict mapping each of PEAK_COLUMNS to an array with shape (n_targets,):
+        area_under_curve: area of the whole (valid) trace
+        peak_area: area above the baseline between the peak boundaries
+        peak_rt, peak_intensity: retention time and intensity of the highest raw point between the peak boundaries
+        peak_start_rt, peak_end_rt: peak boundaries
+        fwhm: full width at half maximum, in minutes
+        signal_to_noise: apex height above the baseline divided by the noise
+    """
+    rt = np.asarray(rt, dtype=np.float64)
+    xic = np.asarray(xic, dtype=np.float64)
+    n_scans, n_targets = xic.shape
+    valid = np.ones(xic.shape, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+    has_points = valid.any(axis=0)
+    summary = {column: np.full(n_targets, np.nan) for column in PEAK_COLUMNS}
+    if n_scans == 0 or not has_points.any():
+        return summary
+
+    columns = np.arange(n_targets)
+    index = np.arange(n_scans)[:, None]
+    raw = np.where(valid, xic, 0.0)
+    trace = np.where(valid, smooth(raw, smooth_window), -np.inf)
+
+    # Whole-trace area, counting only the segments with both ends valid
+    segment_valid = valid[1:] & valid[:-1]
+    segments = 0.5 * (raw[1:] + raw[:-1]) * np.diff(rt)[:, None]
+    summary['area_under_curve'] = np.where(segment_valid, segments, 0.0).sum(axis=0)
+
+    apex = np.argmax(trace, axis=0)
+    baseline, noise = estimate_baseline(raw, valid)
+    apex_height = trace[apex, columns]
+
+    # Boundaries: walking away from the apex, the peak ends at the first point back at the baseline or at a valley
+    # (inclusive), or before the first point out of the window or too far from the apex (exclusive)
+    inside = valid.copy()
+    if max_half_width is not None:
+        inside &= np.abs(rt[:, None] - rt[apex]) <= max_half_width
+    previous = np.vstack([np.full((1, n_targets), np.inf), trace[:-1]])
+    following = np.vstack([trace[1:], np.full((1, n_targets), np.inf)])
+    at_baseline = trace <= baseline + boundary_fraction * (apex_height - baseline)
+    # Highest point of the trace beyond each scan (away from the apex), to keep only the minima followed by a real rise
+    masked = np.where(inside, trace, -np.inf)
+    lower = np.full((1, n_targets), -np.inf)
+    # Points out of the window are -inf on both sides; their rise is NaN and never makes a valley
+    with np.errstate(invalid='ignore'):
+        rise_before = np.vstack([lower, np.maximum.accumulate(masked, axis=0)[:-1]]) - trace
+        rise_after = np.vstack([np.maximum.accumulate(masked[::-1], axis=0)[::-1][1:], lower]) - trace
+    prominence = np.fmax(valley_fraction * (apex_height - baseline), valley_noise * noise)
+    left_stop = inside & (at_baseline | ((trace <= previous) & (trace < following) & (rise_before > prominence)))
+    right_stop = inside & (at_baseline | ((trace < previous) & (trace <= following) & (rise_after > prominence)))
+    before, after = index < apex, index > apex
+    left = np.maximum(np.where(left_stop & before, index, -1).max(axis=0),
+                      np.where(~inside & before, index, -1).max(axis=0) + 1)
+    right = np.minimum(np.where(right_stop & after, index, n_scans).min(axis=0),
+                       np.where(~inside & after, index, n_scans).min(axis=0) - 1)
+
+    # Peak area above the baseline, from the cumulative area of the baseline-subtracted trace
+    above = np.clip(raw - np.nan_to_num(baseline), 0, None)
+    cumulative = np.zeros((n_scans, n_targets), dtype=np.float64)
+    np.cumsum(0.5 * (above[1:] + above[:-1]) * np.diff(rt)[:, None], axis=0, out=cumulative[1:])
+    summary['peak_area'] = cumulative[right, columns] - cumulative[left, columns]
+
+    # The smoothed apex can sit anywhere on the plateau a narrow peak is spread into: report the raw maximum instead
+    in_peak = valid & (index >= left) & (index <= right)
+    raw_apex = np.argmax(np.where(in_peak, raw, -np.inf), axis=0)
+    summary['peak_rt'] = rt[raw_apex]
+    summary['peak_intensity'] = raw[raw_apex, columns]
+    summary['peak_start_rt'] = rt[left]
+    summary['peak_end_rt'] = rt[right]
+
+    # Full width at half maximum, interpolated between the scans around each half-height crossing
+    half = baseline + (apex_height - baseline) / 2
+    below = trace < half
+    half_left = np.where(below & before & (index >= left), index, -1).max(axis=0)
+    half_right = np.where(below & after & (index <= right), index, n_scans).min(axis=0)
+    found_left, found_right = half_left >= 0, half_right < n_scans
+    half_left = np.where(found_left, half_left, apex)
+    half_right = np.where(found_right, half_right, apex)
+    rt_left = np.where(found_left, _crossing(rt, trace, half_left, np.minimum(half_left + 1, n_scans - 1), half),
+                       rt[left])
+    rt_right = np.where(found_right, _crossing(rt, trace, np.maximum(half_right - 1, 0), half_right, half),
+                        rt[right])
+    summary['fwhm'] = rt_right - rt_left
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        summary['signal_to_noise'] = (apex_height - baseline) / noise
+
+    # A trace that never rises above its baseline has no peak
+    flat = ~(apex_height > baseline)
+    summary['peak_area'][flat] = 0.0
+    summary['fwhm'][flat] = 0.0
+    summary['peak_start_rt'][flat] = summary['peak_rt'][flat]
+    summary['peak_end_rt'][flat] = summary['peak_rt'][flat]
+
+    for column in PEAK_COLUMNS:
+        summary[column][~has_points] = np.nan
+    return summary
@@ -1,48 +1,268 @@
-import requests
-import pandas as pd
+import argparse
+import random
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from usi_cache import UsiCache
+
+USI_JSON_URL = 'https://metabolomics-usi.gnps2.org/json/'
+LIBRARY_USI_PREFIX = 'mzspec:GNPS:GNPS-LIBRARY:accession:'
+
+# Status codes worth retrying: rate limited or temporary server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Longest wait in seconds between two attempts, also applied to the Retry-After header of the server
+MAX_BACKOFF = 30.0
+
+
+def create_session(max_workers=16) -> requests.Session:
+    """
+    Create a requests session whose connection pool is large enough for max_workers threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 
+class RateLimiter:
+    """
+    Space out the requests of all threads so that at most `rate` requests start per second.
+    """
 
-def usi_request(usi: str, max_attempts=3, verbose=True):
-    attempts = 0
-    success = False
-    while attempts < max_attempts:  # Try up to 3 times
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def backoff_delay(attempt: int, base=1.0, maximum=MAX_BACKOFF) -> float:
+    """Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt, capped at maximum."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def usi_request(usi: str, max_attempts=3, verbose=True, session: requests.Session = None, base_url=USI_JSON_URL,
+                rate_limiter: RateLimiter = None, backoff=1.0, timeout=30, max_backoff=MAX_BACKOFF):
+    """
+    Request the JSON of a USI from the metabolomics USI resolver.
+    Rate limited (429), server errors and connection errors are retried with exponential backoff and jitter; other
+    errors (e.g. 404 for an unknown USI) are raised immediately.
+    :param usi: USI of the spectrum
+    :param max_attempts: maximum number of attempts
+    :param verbose: print each attempt
+    :param session: requests session to use. If None, requests.get is used
+    :param base_url: URL of the JSON endpoint (e.g. a local stub server when testing)
+    :param rate_limiter: RateLimiter shared by all the threads making requests
+    :param backoff: base delay in seconds of the exponential backoff
+    :param timeout: connection/read timeout in seconds
+    :param max_backoff: longest wait in seconds between two attempts, whatever the Retry-After header asks for
+    :return: requests.Response
+    """
+    http = session or requests
+    usi = str(usi).strip()
+    for attempt in range(max_attempts):
         if verbose:
-            print(f'Requesting {usi} (Attempt {attempts + 1})')
-        response = requests.get('https://metabolomics-usi.gnps2.org/json/?usi1=' + str(usi).strip())
+            print(f'Requesting {usi} (Attempt {attempt + 1})')
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            response = http.get(base_url, params={'usi1': usi}, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt + 1 == max_attempts:
+                raise
+            if verbose:
+                print(f'Attempt {attempt + 1} failed for {usi}: {e}')
+            time.sleep(backoff_delay(attempt, backoff, max_backoff))
+            continue
+
         if response.status_code == 200:
-            print(f'Attempt {attempts + 1} successful for {usi}.')
-            success = True
+            if verbose:
+                print(f'Attempt {attempt + 1} successful for {usi}.')
             return response
-            # break  # Exit the retry loop if successful
+        if verbose:
+            print(f'Attempt {attempt + 1} failed for {usi}.')
+            print(f'status code: {response.status_code}.')
+        if response.status_code not in RETRY_STATUS or attempt + 1 == max_attempts:
+            break
+
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = min(float(retry_after), max_backoff)
         else:
-            if verbose:
-                print(f'Attempt {attempts + 1} failed for {usi}.')
-                print(f'status code: {response.status_code}.')
-            attempts += 1
-            # sleeps for 1 second
-            time.sleep(1)
+            delay = backoff_delay(attempt, backoff, max_backoff)
+        time.sleep(delay)
 
-    if not success:  # If all attempts fail, break the outer loops
-        if verbose:
-            print(f'{usi} failed after 3 attempts. Please verify if it is valid.')
-        response.raise_for_status()
+    if verbose:
+        print(f'{usi} failed after {attempt + 1} attempts. Please verify if it is valid.')
+    response.raise_for_status()
+    raise requests.HTTPError(f'Unexpected status code {response.status_code} for {usi}', response=response)
+
+
+def usi_json(usi: str, cache: UsiCache = None, **request_kwargs) -> dict:
+    """
+    Get the JSON of a USI, reading through the local USI cache when one is given.
+    :param usi: USI of the spectrum
+    :param cache: UsiCache to read from and store into. If None, the endpoint is always requested
+    :param request_kwargs: arguments of usi_request
+    :return: dict with at least 'precursor_mz', 'precursor_charge' and 'peaks'
+    """
+    if cache is None:
+        return usi_request(usi, **request_kwargs).json()
+    return cache.fetch(str(usi).strip(), lambda key: usi_request(key, **request_kwargs).json())
+
+
+class UsiResolver:
+    """
+    Resolve USIs concurrently with a bounded thread pool sharing one session and one rate limiter.
+    Concurrent lookups of the same USI are coalesced: while a USI is being requested, submitting it again returns the
+    future of the request in flight instead of starting a new one.
+
+    Example:
+        with UsiResolver(max_workers=16) as resolver:
+            resolved, errors = resolver.resolve(usis)
+    """
+
+    def __init__(self, max_workers=16, requests_per_second=20, max_attempts=5, session=None, base_url=USI_JSON_URL,
+                 verbose=False, cache: UsiCache = None):
+        """
+        :param max_workers: maximum number of simultaneous requests
+        :param requests_per_second: global limit of requests started per second (None or 0 for no limit)
+        :param max_attempts: maximum number of attempts per USI
+        :param session: requests session to use. If None, a pooled session is created
+        :param base_url: URL of the JSON endpoint
+        :param verbose: print each attempt
+        :param cache: UsiCache read through before requesting the endpoint
+        """
+        self.request_kwargs = dict(max_attempts=max_attempts, verbose=verbose,
+                                   session=session or create_session(max_workers), base_url=base_url,
+                                   rate_limiter=RateLimiter(requests_per_second))
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, usi):
+        return float(usi_json(usi, cache=self.cache, **self.request_kwargs)['precursor_mz'])
+
+    def _forget(self, usi, future):
+        with self._lock:
+            if self._inflight.get(usi) is future:
+                del self._inflight[usi]
+
+    def submit(self, usi: str) -> Future:
+        """
+        Start the lookup of a USI, or join the lookup already in flight for it.
+        :param usi: USI of the spectrum
+        :return: Future of the precursor m/z
+        """
+        usi = str(usi).strip()
+        with self._lock:
+            future = self._inflight.get(usi)
+            if future is not None:
+                return future
+            future = self.executor.submit(self._lookup, usi)
+            self._inflight[usi] = future
+        # Outside the lock: the callback runs immediately if the lookup already finished
+        future.add_done_callback(lambda done: self._forget(usi, done))
+        return future
 
+    def resolve(self, usis) -> tuple:
+        """
+        Resolve the precursor m/z of many USIs. Duplicated USIs are requested only once.
+        :param usis: iterable of USIs
+        :return: tuple of (DataFrame indexed by the unique USIs with a 'prec_mz' column, NaN where the lookup failed;
+        dict mapping each failed USI to its exception)
+        """
+        unique = pd.unique(pd.Series(list(usis), dtype=str).str.strip())
+        prec_mz = np.full(len(unique), np.nan)
+        errors = {}
 
-def retrieve_prec_mz(csv_path: str, save_to: str):
+        futures = {self.submit(usi): i for i, usi in enumerate(unique)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Resolving USIs'):
+            i = futures[future]
+            try:
+                prec_mz[i] = future.result()
+            except Exception as e:
+                errors[unique[i]] = e
+
+        return pd.DataFrame({'prec_mz': prec_mz}, index=pd.Index(unique, name='usi')), errors
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def retrieve_prec_mz(csv_path: str, save_to: str, max_workers=16, requests_per_second=20, base_url=USI_JSON_URL,
+                     cache: UsiCache = None):
     df = pd.read_csv(csv_path)
-    df['prec_mz'] = ''
-    for i, row in df.iterrows():
-        response = usi_request(f'mzspec:GNPS:GNPS-LIBRARY:accession:{row['USI']}')
-        df.at[i, 'prec_mz'] = response.json()['precursor_mz']
+    usis = LIBRARY_USI_PREFIX + df['USI'].astype(str).str.strip()
+    with UsiResolver(max_workers=max_workers, requests_per_second=requests_per_second, base_url=base_url,
+                     cache=cache) as resolver:
+        resolved, errors = resolver.resolve(usis)
+    print(f'Resolved {len(resolved)} unique USIs for {len(df)} rows.')
+
+    # Broadcast the results of the unique USIs back to every row
+    df['prec_mz'] = resolved['prec_mz'].reindex(usis).to_numpy()
+
+    for usi, error in errors.items():
+        print(f'Failed to resolve {usi}: {error}')
+    if errors:
+        print(f'{len(errors)} of {len(resolved)} USIs could not be resolved; their prec_mz is left empty.')
+
+    if cache is not None:
+        stats = cache.stats()
+        print(f"USI cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries in {cache.path}")
 
     df.to_csv(save_to, sep='\t', index=False)
 
 
 def main():
-    csv_path = '../mzml_download/Julius_USI.csv'
-    save_to = './Julius_USI_precmz.tsv'
-    retrieve_prec_mz(csv_path, save_to)
+    parser = argparse.ArgumentParser(description='Retrieve the precursor m/z of GNPS library accessions')
+    parser.add_argument('csv_path', nargs='?', default='../mzml_download/Julius_USI.csv',
+                        help='CSV with a USI column of GNPS library accessions')
+    parser.add_argument('save_to', nargs='?', default='./Julius_USI_precmz.tsv', help='Output TSV')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='Number of simultaneous requests (default: 16)')
+    parser.add_argument('--rate', type=float, default=20,
+                        help='Maximum number of requests per second, 0 for no limit (default: 20)')
+    parser.add_argument('--base-url', default=USI_JSON_URL, help=f'USI JSON endpoint (default: {USI_JSON_URL})')
+    parser.add_argument('--cache', default=None,
+                        help='USI cache file (default: USI_CACHE_PATH environment variable or ~/.cache/usi_cache.sqlite)')
+    parser.add_argument('--cache-ttl-days', type=float, default=30,
+                        help='Days after which cached USIs are requested again, 0 to never expire (default: 30)')
+    parser.add_argument('--no-cache', action='store_true', help='Always request the endpoint')
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        cache = UsiCache(args.cache, ttl=args.cache_ttl_days * 24 * 3600 if args.cache_ttl_days else None)
+    try:
+        retrieve_prec_mz(args.csv_path, args.save_to, max_workers=args.workers, requests_per_second=args.rate,
+                         base_url=args.base_url, cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
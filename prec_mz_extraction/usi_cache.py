@@ -0,0 +1,203 @@
+"""
+USI Metadata Cache
+Local SQLite store of the spectra resolved through the metabolomics USI JSON endpoint, keyed by USI. Each entry holds
+the precursor m/z, the charge and the peak arrays, so lookups already made by any tool (prec_mz_extraction,
+mgf_spectra_plot) are answered locally, and still work offline.
+Entries expire after a time-to-live and the least recently used ones are evicted above a maximum number of entries.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.environ.get('USI_CACHE_PATH',
+                                    os.path.join(os.path.expanduser('~'), '.cache', 'usi_cache.sqlite'))
+DEFAULT_TTL = 30 * 24 * 3600  # seconds
+DEFAULT_MAX_ENTRIES = 1_000_000
+EVICT_EVERY = 1000  # insertions between two evictions
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def record_from_json(data: dict) -> tuple:
+    """
+    Extract the cached fields from the JSON returned by the USI endpoint.
+    :param data: dict with 'precursor_mz', 'precursor_charge' and 'peaks' ([[mz, intensity], ...])
+    :return: tuple of (precursor m/z, charge, m/z bytes, intensity bytes)
+    """
+    peaks = np.asarray(data.get('peaks') or [], dtype=np.float64).reshape(-1, 2)
+    charge = data.get('precursor_charge')
+    return (float(data['precursor_mz']), None if charge is None else int(charge),
+            np.ascontiguousarray(peaks[:, 0]).tobytes(), np.ascontiguousarray(peaks[:, 1]).tobytes())
+
+
+def json_from_record(precursor_mz, charge, mz, intensity) -> dict:
+    """Inverse of record_from_json: rebuild the JSON fields of a cached spectrum."""
+    mz = np.frombuffer(mz, dtype=np.float64)
+    intensity = np.frombuffer(intensity, dtype=np.float64)
+    return {'precursor_mz': precursor_mz, 'precursor_charge': charge,
+            'peaks': np.column_stack((mz, intensity)).tolist(), 'n_peaks': len(mz)}
+
+
+class UsiCache:
+    """
+    Persistent USI -> spectrum cache, safe to share between threads (and between processes through SQLite locking).
+
+    Example:
+        cache = UsiCache()
+        data = cache.fetch(usi, lambda usi: requests.get(url, params={'usi1': usi}).json())
+        print(cache.stats())
+    """
+
+    def __init__(self, path: str = None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param path: path of the SQLite file (default: USI_CACHE_PATH environment variable or ~/.cache/usi_cache.sqlite)
+        :param ttl: time in seconds after which an entry is fetched again. None to never expire
+        :param max_entries: maximum number of entries kept. None for no limit
+        """
+        self.path = path or DEFAULT_CACHE_PATH
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._inserted = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        with self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS spectra (usi TEXT PRIMARY KEY, precursor_mz REAL, '
+                                     'charge INTEGER, mz BLOB, intensity BLOB, fetched REAL, accessed REAL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS spectra_accessed ON spectra (accessed)')
+
+    def _is_fresh(self, fetched, now):
+        return self.ttl is None or now - fetched <= self.ttl
+
+    def get(self, usi: str, allow_expired=False) -> dict | None:
+        """
+        Read a cached spectrum.
+        :param usi: USI of the spectrum
+        :param allow_expired: also return entries older than the time-to-live (e.g. when the endpoint is unreachable)
+        :return: dict with 'precursor_mz', 'precursor_charge', 'peaks' and 'n_peaks', or None if not cached
+        """
+        return self.get_many([usi], allow_expired=allow_expired).get(str(usi).strip())
+
+    def get_many(self, usis, allow_expired=False) -> dict:
+        """
+        Read many cached spectra at once.
+        :param usis: iterable of USIs
+        :param allow_expired: see get
+        :return: dict mapping each cached USI to its spectrum (USIs that are not cached are left out)
+        """
+        keys = list(dict.fromkeys(str(usi).strip() for usi in usis))
+        now = time.time()
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT usi, precursor_mz, charge, mz, intensity, fetched FROM spectra '
+                    f'WHERE usi IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+                for usi, precursor_mz, charge, mz, intensity, fetched in rows:
+                    if allow_expired or self._is_fresh(fetched, now):
+                        found[usi] = json_from_record(precursor_mz, charge, mz, intensity)
+            if found:
+                with self._connection:
+                    self._connection.executemany('UPDATE spectra SET accessed = ? WHERE usi = ?',
+                                                 [(now, usi) for usi in found])
+            if not allow_expired:
+                self.hits += len(found)
+                self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, usi: str, data: dict):
+        """
+        Store the JSON of a spectrum.
+        :param usi: USI of the spectrum
+        :param data: JSON returned by the USI endpoint
+        """
+        self.put_many({usi: data})
+
+    def put_many(self, items: dict):
+        """Store several spectra (dict mapping each USI to its JSON) in one transaction."""
+        now = time.time()
+        rows = [(str(usi).strip(), *record_from_json(data), now, now) for usi, data in items.items()]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany('INSERT OR REPLACE INTO spectra VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._inserted += len(rows)
+            if self._inserted >= EVICT_EVERY:
+                self._evict()
+
+    def fetch(self, usi: str, fetch_json) -> dict:
+        """
+        Read a spectrum through the cache: return the cached entry, or call fetch_json(usi), store and return its
+        result. If fetch_json fails and an expired entry exists, the expired entry is returned instead.
+        :param usi: USI of the spectrum
+        :param fetch_json: callable returning the JSON of the USI from the endpoint
+        :return: dict with at least 'precursor_mz', 'precursor_charge' and 'peaks'
+        """
+        cached = self.get(usi)
+        if cached is not None:
+            return cached
+        try:
+            data = fetch_json(usi)
+        except Exception:
+            stale = self.get(usi, allow_expired=True)
+            if stale is None:
+                raise
+            return stale
+        self.put(usi, data)
+        return data
+
+    def _evict(self):
+        self._inserted = 0
+        with self._connection:
+            if self.ttl is not None:
+                self._connection.execute('DELETE FROM spectra WHERE fetched < ?', (time.time() - self.ttl,))
+            if self.max_entries is not None:
+                self._connection.execute(
+                    'DELETE FROM spectra WHERE usi IN (SELECT usi FROM spectra ORDER BY accessed DESC '
+                    'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def evict(self):
+        """Remove the expired entries and the least recently used ones above max_entries."""
+        with self._lock:
+            self._evict()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM spectra').fetchone()[0]
+
+    def stats(self) -> dict:
+        """Hit/miss counters of this instance and number of entries in the store."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self)}
+
+    def close(self):
+        with self._lock:
+            if self._inserted:
+                self._evict()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def default_cache() -> UsiCache:
+    """Process-wide UsiCache at DEFAULT_CACHE_PATH, opened on first use."""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = UsiCache()
+        return _default_cache